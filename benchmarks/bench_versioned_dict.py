@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015 ibu@radempa.de
+#
+# Permission is hereby granted, free of charge, to
+# any person obtaining a copy of this software and
+# associated documentation files (the "Software"),
+# to deal in the Software without restriction,
+# including without limitation the rights to use,
+# copy, modify, merge, publish, distribute,
+# sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is
+# furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission
+# notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY
+# OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT
+# LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE,
+# ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Benchmarks for :class:`versioned_dict.VersionedDict`.
+
+Each case builds a history of versions and measures the time per call of
+:meth:`forward_version`, :meth:`lookup_value`, :meth:`lookup_version`,
+:meth:`keys_in_version`, :meth:`diff_pair` and :meth:`rewind_version`.
+Starting from a base case, one parameter at a time is varied:
+
+  * *keys*: number of keys in each version
+  * *versions*: number of archived versions
+  * *churn*: fraction of the keys modified per version
+  * *value_size*: approximate size of a value in bytes
+  * *depth*: nesting depth of the values
+
+Timings are the minimum over *--repeat* runs. The history is built once
+more under :mod:`tracemalloc` to report the peak memory next to them.
+The results are written as JSON::
+
+    python benchmarks/bench_versioned_dict.py run -o before.json
+    python benchmarks/bench_versioned_dict.py run -o after.json
+    python benchmarks/bench_versioned_dict.py compare before.json after.json
+
+*compare* lists the timings and memory peaks which got worse by more than
+*--threshold* (relative) and exits with status 1 if there are any.
+"""
+
+import argparse
+import ast
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from versioned_dict import VersionedDict  # noqa: E402
+
+
+BASE = {
+    'keys': 1000,
+    'versions': 100,
+    'churn': 0.1,
+    'value_size': 100,
+    'depth': 0,
+}
+
+AXES = {
+    'keys': [100, 1000, 10000],
+    'versions': [10, 100, 1000],
+    'churn': [0.01, 0.1, 0.5],
+    'value_size': [10, 100, 1000],
+    'depth': [0, 2, 4],
+}
+
+QUICK_BASE = {
+    'keys': 100,
+    'versions': 20,
+    'churn': 0.1,
+    'value_size': 20,
+    'depth': 0,
+}
+
+QUICK_AXES = {
+    'keys': [10, 100],
+    'versions': [5, 20],
+    'churn': [0.1, 0.5],
+    'value_size': [20, 200],
+    'depth': [0, 2],
+}
+
+OPERATIONS = (
+    'forward_version',
+    'lookup_value',
+    'lookup_version',
+    'keys_in_version',
+    'diff_pair',
+    'rewind_version',
+)
+
+
+def make_value(rnd, size, depth):
+    """
+    Return a random value of about *size* bytes nested *depth* levels.
+
+    Each level is a dict holding a list and the next level; the leaf is
+    a string of *size* characters.
+    """
+    if depth <= 0:
+        return ''.join(rnd.choice('abcdefghijklmnopqrstuvwxyz')
+                       for _ in range(size))
+    return {
+        'depth': depth,
+        'items': [rnd.randrange(1000) for _ in range(4)],
+        'child': make_value(rnd, size, depth - 1),
+    }
+
+
+def case_name(params):
+    """
+    Return a stable name for the case with *params*.
+    """
+    return ','.join('%s=%s' % (name, params[name]) for name in sorted(params))
+
+
+def build(params, options, seed):
+    """
+    Build a history for *params* and return it with the forward timings.
+
+    Every version modifies ``churn * keys`` keys; a tenth of that number
+    of keys is deleted and as many new keys are added.
+    """
+    rnd = random.Random(seed)
+    n_keys = params['keys']
+    size = params['value_size']
+    depth = params['depth']
+    vd = VersionedDict(**options)
+    for i in range(n_keys):
+        vd['k%d' % i] = make_value(rnd, size, depth)
+    n_changed = max(1, int(round(params['churn'] * n_keys)))
+    n_replaced = n_changed // 10
+    next_key = n_keys
+    elapsed = 0.0
+    for _ in range(params['versions']):
+        start = time.perf_counter()
+        vd.forward_version()
+        elapsed += time.perf_counter() - start
+        keys = list(vd.keys())
+        for key in rnd.sample(keys, min(n_changed, len(keys))):
+            vd[key] = make_value(rnd, size, depth)
+        for key in rnd.sample(keys, min(n_replaced, len(keys))):
+            del vd[key]
+            vd['k%d' % next_key] = make_value(rnd, size, depth)
+            next_key += 1
+    return vd, elapsed / max(1, params['versions'])
+
+
+def time_calls(calls):
+    """
+    Run the callables in *calls* and return the mean seconds per call.
+    """
+    start = time.perf_counter()
+    for call in calls:
+        call()
+    return (time.perf_counter() - start) / max(1, len(calls))
+
+
+def measure(params, options, samples, seed):
+    """
+    Return the seconds per call of each operation for one history.
+    """
+    vd, forward = build(params, options, seed)
+    rnd = random.Random(seed + 1)
+    n_versions = params['versions']
+    versions = [rnd.randrange(n_versions) for _ in range(samples)]
+    keys = [rnd.choice(sorted(vd.keys_in_version(v))) for v in versions]
+    timings = {'forward_version': forward}
+    timings['lookup_value'] = time_calls([
+        lambda k=k, v=v: vd.lookup_value(k, v)
+        for k, v in zip(keys, versions)])
+    timings['lookup_version'] = time_calls([
+        lambda v=v: vd.lookup_version(v) for v in versions])
+    timings['keys_in_version'] = time_calls([
+        lambda v=v: vd.keys_in_version(v) for v in versions])
+    pairs = [sorted(rnd.sample(range(n_versions), 2))
+             for _ in range(samples)]
+    timings['diff_pair'] = time_calls([
+        lambda v=v, w=w: vd.diff_pair(v, w) for v, w in pairs])
+    timings['rewind_version'] = time_calls([
+        vd.rewind_version for _ in range(min(samples, n_versions))])
+    return timings
+
+
+def measure_memory(params, options, seed):
+    """
+    Return the peak and retained bytes allocated while building a history.
+    """
+    tracemalloc.start()
+    try:
+        vd, _ = build(params, options, seed)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    stats = vd.archive_stats()
+    return {
+        'peak_bytes': peak,
+        'retained_bytes': current,
+        'archive_bytes': stats['archive_bytes'],
+    }
+
+
+def cases(base, axes):
+    """
+    Yield the parameter sets: the base case and one per axis value.
+    """
+    seen = set()
+    for name in axes:
+        for value in axes[name]:
+            params = dict(base)
+            params[name] = value
+            key = case_name(params)
+            if key not in seen:
+                seen.add(key)
+                yield params
+
+
+def run(args):
+    """
+    Run all cases and write the results as JSON.
+    """
+    base = dict(QUICK_BASE if args.quick else BASE)
+    axes = dict(QUICK_AXES if args.quick else AXES)
+    for name in args.axis or []:
+        if name not in axes:
+            raise SystemExit('unknown axis: %s' % name)
+    if args.axis:
+        axes = {name: axes[name] for name in args.axis}
+    options = dict(args.option or [])
+    results = []
+    for params in cases(base, axes):
+        name = case_name(params)
+        print('running %s' % name, file=sys.stderr)
+        best = {}
+        for i in range(args.repeat):
+            timings = measure(params, options, args.samples, args.seed)
+            for op, seconds in timings.items():
+                best[op] = min(seconds, best.get(op, seconds))
+        result = {'name': name, 'params': params, 'timings': best}
+        result['memory'] = measure_memory(params, options, args.seed)
+        results.append(result)
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'repeat': args.repeat,
+            'samples': args.samples,
+            'seed': args.seed,
+            'options': {key: repr(value) for key, value in options.items()},
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    return 0
+
+
+def compare_results(old, new, threshold):
+    """
+    Compare two reports and return the rows of the comparison.
+
+    Each row is (case, metric, old, new, ratio, regressed); a metric has
+    regressed if it grew by more than *threshold*. Cases present in only
+    one of the reports are skipped.
+    """
+    old_results = {result['name']: result for result in old['results']}
+    rows = []
+    for result in new['results']:
+        previous = old_results.get(result['name'])
+        if previous is None:
+            continue
+        metrics = [(op, previous['timings'].get(op), result['timings'][op])
+                   for op in OPERATIONS if op in result['timings']]
+        metrics.append(('peak_bytes', previous['memory']['peak_bytes'],
+                        result['memory']['peak_bytes']))
+        for metric, before, after in metrics:
+            if not before:
+                continue
+            ratio = after / before
+            rows.append((result['name'], metric, before, after, ratio,
+                         ratio > 1 + threshold))
+    return rows
+
+
+def compare(args):
+    """
+    Print the comparison of two result files; return 1 on regressions.
+    """
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    rows = compare_results(old, new, args.threshold)
+    regressions = 0
+    for name, metric, before, after, ratio, regressed in rows:
+        if regressed:
+            regressions += 1
+        if regressed or args.verbose:
+            print('%-10s %-60s %-16s %12.6g %12.6g %7.2fx' % (
+                'REGRESSION' if regressed else 'ok', name, metric,
+                before, after, ratio))
+    print('%d of %d metrics regressed by more than %d%%' % (
+        regressions, len(rows), round(args.threshold * 100)))
+    return 1 if regressions else 0
+
+
+def parse_option(text):
+    """
+    Parse a ``name=value`` constructor option; the value is a literal
+    if possible and a string otherwise.
+    """
+    name, sep, value = text.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError('expected name=value: %s' % text)
+    try:
+        value = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        pass
+    return name, value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark VersionedDict and compare results.')
+    commands = parser.add_subparsers(dest='command')
+    run_parser = commands.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('-o', '--output',
+                            help='write the JSON results to this file')
+    run_parser.add_argument('--quick', action='store_true',
+                            help='use small sizes for a smoke test')
+    run_parser.add_argument('--axis', action='append', choices=sorted(AXES),
+                            help='vary only this axis (repeatable)')
+    run_parser.add_argument('--option', action='append', type=parse_option,
+                            help='VersionedDict option as name=value '
+                                 '(repeatable)')
+    run_parser.add_argument('--repeat', type=int, default=3,
+                            help='runs per case; the minimum is reported')
+    run_parser.add_argument('--samples', type=int, default=100,
+                            help='calls per measured operation')
+    run_parser.add_argument('--seed', type=int, default=0)
+    compare_parser = commands.add_parser(
+        'compare', help='flag regressions between two result files')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='relative increase regarded as a '
+                                     'regression (default: 0.1)')
+    compare_parser.add_argument('-v', '--verbose', action='store_true',
+                                help='list all metrics, not only '
+                                     'regressions')
+    args = parser.parse_args(argv)
+    if args.command == 'compare':
+        return compare(args)
+    if args.command is None:
+        args = parser.parse_args(['run'])
+    return run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
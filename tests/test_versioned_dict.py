@@ -31,7 +31,15 @@
 Unit tests for :mod:`versioned_dict`.
 """
 
+import os
+import pickle
+import random
+import tempfile
+import threading
 import unittest
+import zlib
+from copy import deepcopy
+from unittest import mock
 from versioned_dict import *
 
 
@@ -193,3 +201,840 @@ class TestVersionedDict(unittest.TestCase):
         self.assertTrue(x1 is d['x1'])
         self.assertTrue(x1[0][2] == d.lookup_version(0)['x1'][0][2])
         self.assertTrue(x1[0][2]['h'] == d.lookup_version(0)['x1'][0][2]['h'])
+
+    def test_touched_keys(self):
+        d = VersionedDict(a=1, b=2, c=3, d=4, e=5, f=[6])
+        d.forward_version()
+        d['a'] = 10
+        del d['b']
+        d.update(g=7)
+        d |= {'h': 8}
+        self.assertEqual(3, d.pop('c'))
+        self.assertEqual(9, d.setdefault('i', 9))
+        self.assertEqual(4, d.setdefault('d', 0))
+        d['e'] = 5
+        d['f'].append(7)
+        self.assertEqual((dict(g=7, h=8, i=9), dict(b=2, c=3), dict(a=10)),
+                         d.diff_previous())
+        self.assertEqual(2, d.forward_version())
+        self.assertEqual(dict(a=1, b=2, c=3, d=4, e=5, f=[6]),
+                         d.lookup_version(0))
+        self.assertEqual((dict(), dict(), dict()), d.diff_previous())
+        key, value = d.popitem()
+        self.assertEqual(({}, {key: value}, {}), d.diff_previous())
+        d.clear()
+        self.assertEqual(3, d.forward_version())
+        self.assertEqual(dict(), d.lookup_version(2))
+        self.assertEqual(2, d.rewind_version())
+        self.assertEqual(1, d.rewind_version())
+        self.assertEqual(dict(a=10, d=4, e=5, f=[6], g=7, h=8, i=9), d)
+
+    def test_full_diff(self):
+        d = VersionedDict(f=[6], full_diff=True)
+        self.assertEqual(dict(f=[6]), d)
+        d.forward_version()
+        d['f'].append(7)
+        self.assertEqual((dict(), dict(), dict(f=[6, 7])), d.diff_previous())
+        self.assertEqual(2, d.forward_version())
+        self.assertEqual(dict(f=[6]), d.lookup_version(0))
+        self.assertEqual(dict(f=[6, 7]), d.lookup_version(1))
+
+    def test_history_index(self):
+        d = VersionedDict()
+        snapshots = []
+        for i in range(30):
+            d['k%i' % (i % 7)] = i
+            if i % 3 == 0:
+                d.pop('k%i' % (i % 5), None)
+            snapshots.append(dict(d))
+            d.forward_version()
+        for _ in range(5):
+            d.rewind_version()
+            del snapshots[-1]
+        for version_n, snapshot in enumerate(snapshots):
+            for i in range(7):
+                key = 'k%i' % i
+                if key in snapshot:
+                    self.assertEqual(snapshot[key],
+                                     d.lookup_value(key, version_n=version_n))
+                else:
+                    with self.assertRaises(KeyError):
+                        d.lookup_value(key, version_n=version_n)
+        with self.assertRaises(KeyError):
+            d.lookup_value('x', version_n=3)
+
+    def test_checkpoints(self):
+        with self.assertRaises(ValueError):
+            VersionedDict(checkpoint_interval=0)
+        d = VersionedDict(checkpoint_interval=4)
+        snapshots = []
+        for i in range(18):
+            d['k%i' % (i % 5)] = i
+            if i % 4 == 1:
+                del d['k%i' % (i % 5)]
+            snapshots.append(dict(d))
+            d.forward_version()
+        stats = d.archive_stats()
+        self.assertEqual(18, stats['versions'])
+        self.assertEqual(4, stats['checkpoints'])
+        self.assertEqual(sum(len(snapshots[i]) for i in (4, 8, 12, 16)),
+                         stats['checkpoint_entries'])
+        self.assertTrue(stats['checkpoint_bytes'] > 0)
+        d.rewind_version()
+        d.rewind_version()
+        del snapshots[-2:]
+        self.assertEqual(3, d.archive_stats()['checkpoints'])
+        for version_n, snapshot in enumerate(snapshots):
+            self.assertEqual(snapshot, d.lookup_version(version_n))
+            self.assertEqual(set(snapshot), d.keys_in_version(version_n))
+
+    def test_rewind_affected_keys(self):
+        big = list(range(100))
+        d = VersionedDict(a=1, b=2, big=big)
+        d.forward_version()
+        d['a'] = 10
+        del d['b']
+        d['c'] = 3
+        d.forward_version()
+        d['a'] = 100
+        d['b'] = 20
+        del d['c']
+        self.assertEqual(1, d.rewind_version())
+        self.assertEqual(dict(a=10, c=3, big=big), d)
+        self.assertTrue(d['big'] is big)
+        self.assertEqual((dict(c=3), dict(b=2), dict(a=10)), d.diff_previous())
+        self.assertEqual(0, d.rewind_version())
+        self.assertEqual(dict(a=1, b=2, big=big), d)
+        self.assertTrue(d['big'] is big)
+        d = VersionedDict(f=[6], full_diff=True)
+        d.forward_version()
+        d['f'].append(7)
+        self.assertEqual(0, d.rewind_version())
+        self.assertEqual(dict(f=[6]), d)
+
+    def test_copy_strategy(self):
+        with self.assertRaises(ValueError):
+            VersionedDict(copy_strategy='unknown')
+        x1 = [{'h': 'ha'}]
+        t1 = ('frozen', (1, 2))
+        for copy_strategy in ('deep', 'shallow', 'none', 'pickle'):
+            d = VersionedDict(x1=x1, t1=t1, copy_strategy=copy_strategy)
+            d.forward_version()
+            archived = d.lookup_version(0)
+            self.assertEqual(dict(x1=x1, t1=t1), archived)
+            self.assertTrue(t1 is archived['t1'])
+            self.assertEqual(copy_strategy == 'none', x1 is archived['x1'])
+            self.assertEqual(copy_strategy in ('shallow', 'none'),
+                             x1[0] is archived['x1'][0])
+        copied = []
+
+        def copy_strategy(obj):
+            copied.append(obj)
+            return list(obj)
+        d = VersionedDict(x1=x1, s='s', copy_strategy=copy_strategy)
+        d.forward_version()
+        self.assertEqual([x1], copied)
+        d['x1'] = [1]
+        self.assertEqual(0, d.rewind_version())
+        self.assertEqual(dict(x1=x1, s='s'), d)
+        self.assertFalse(x1 is d['x1'])
+        self.assertEqual(2, len(copied))
+
+    def test_pickle(self):
+        for copy_strategy in ('deep', 'shallow', 'none', 'pickle'):
+            d = VersionedDict(a=1, copy_strategy=copy_strategy)
+            d.forward_version()
+            d['b'] = [2]
+            copied = pickle.loads(pickle.dumps(d))
+            self.assertEqual({'a': 1, 'b': [2]}, copied)
+            self.assertEqual(1, copied.version_number)
+            self.assertEqual({'a': 1}, copied.lookup_version(0))
+            copied.forward_version()
+            self.assertEqual({'a': 1, 'b': [2]}, copied.lookup_version(1))
+            self.assertEqual(1, d.version_number)
+
+    def test_view(self):
+        d = VersionedDict(a=1, b=2)
+        d.forward_version()
+        d['c'] = 3
+        del d['a']
+        d.forward_version()
+        d['d'] = 4
+        view0 = d.view(0)
+        view1 = d.view(1)
+        self.assertEqual(dict(a=1, b=2), view0)
+        self.assertEqual(dict(b=2, c=3), dict(view1))
+        self.assertEqual(1, view1.version_number)
+        self.assertEqual(3, view1['c'])
+        self.assertTrue('b' in view1)
+        self.assertFalse('a' in view1)
+        self.assertEqual(2, len(view1))
+        self.assertEqual({'b', 'c'}, set(view1))
+        with self.assertRaises(KeyError):
+            view1['d']
+        current = d.view(2)
+        self.assertEqual(2, current.version_number)
+        self.assertEqual(4, current['d'])
+        with self.assertRaises(TypeError):
+            current['e'] = 5
+        d['e'] = 5
+        self.assertEqual({'b', 'c', 'd', 'e'}, set(current))
+        d.forward_version()
+        d['e'] = 6
+        with self.assertRaises(VersionedDictStaleViewError):
+            current['e']
+        self.assertEqual(5, d.view(2)['e'])
+        d.rewind_version()
+        with self.assertRaises(VersionedDictInvalidVersionError):
+            d.view(3)
+        d.rewind_version()
+        d.forward_version()
+        with self.assertRaises(VersionedDictStaleViewError):
+            view1['b']
+        with self.assertRaises(VersionedDictStaleViewError):
+            len(view1)
+        self.assertEqual(1, view0['a'])
+
+    def test_diff_pair_folded(self):
+        d = VersionedDict(a=1, b=2, c=3)
+        d.forward_version()
+        d['a'] = 10
+        del d['b']
+        d['x'] = 0
+        d.forward_version()
+        d['a'] = 1
+        d['b'] = 20
+        del d['x']
+        d['c'] = 30
+        d.forward_version()
+        d['d'] = 4
+        self.assertEqual((dict(), dict(), dict(b=20, c=30)),
+                         d.diff_pair(0, 2))
+        self.assertEqual((dict(b=20), dict(x=0), dict(a=1, c=30)),
+                         d.diff_pair(1, 2))
+        self.assertEqual((dict(d=4), dict(), dict(b=20, c=30)),
+                         d.diff_pair(0, 3))
+        self.assertEqual((dict(), dict(), dict()), d.diff_pair(2, 0))
+        self.assertEqual((dict(), dict(d=4), dict(b=2, c=3)),
+                         d.diff_pair(3, 0, reverse=True))
+        self.assertEqual((dict(x=0), dict(b=20), dict(a=10, c=3)),
+                         d.diff_pair(2, 1, reverse=True))
+        with self.assertRaises(VersionedDictInvalidVersionError):
+            d.diff_pair(0, 4)
+
+    def test_nested_deltas(self):
+        doc = {'text': 'x' * 5000, 'meta': {'n': 1, 'tags': ['a', 'b']},
+               'seen': {1, 2}, 'parts': [[1], [2], [3]]}
+        d = VersionedDict(doc=doc, small={'n': 1}, nested_deltas=True,
+                          nested_threshold=1000, checkpoint_interval=3)
+        snapshots = []
+        changes = [
+            lambda doc: doc['meta'].update(n=2),
+            lambda doc: doc['meta']['tags'].append('c'),
+            lambda doc: doc['seen'].add(3),
+            lambda doc: doc.pop('seen'),
+            lambda doc: doc['parts'].insert(1, [4]),
+            lambda doc: doc['parts'][0].append(5),
+            lambda doc: doc.update(text='y'),
+        ]
+        for change in changes:
+            snapshots.append(deepcopy(dict(d)))
+            d.forward_version()
+            doc = deepcopy(d['doc'])
+            change(doc)
+            d['doc'] = doc
+            d['small'] = {'n': d['small']['n'] + 1}
+        snapshots.append(deepcopy(dict(d)))
+        d.forward_version()
+        for version_n, snapshot in enumerate(snapshots):
+            self.assertEqual(snapshot, d.lookup_version(version_n))
+            self.assertEqual(snapshot['doc'],
+                             d.lookup_value('doc', version_n=version_n))
+        self.assertTrue(d.lookup_value('doc', 0)['text'] is
+                        d.lookup_value('doc', 5)['text'])
+        self.assertEqual([[snapshot['doc'] for snapshot in snapshots]],
+                         d.lookup_values(['doc'], range(len(snapshots)),
+                                         dense=True))
+        self.assertEqual([snapshot['doc'] for snapshot in snapshots],
+                         [value for _, value in d.key_history('doc')])
+        self.assertEqual((dict(), dict(), snapshots[2]),
+                         d.diff_previous(3))
+        self.assertEqual((dict(), dict(), snapshots[6]),
+                         d.diff_pair(1, 6))
+        self.assertEqual((dict(), dict(), snapshots[1]),
+                         d.diff_pair(6, 1, reverse=True))
+        for version_n in reversed(range(len(snapshots))):
+            self.assertEqual(version_n, d.rewind_version())
+            self.assertEqual(snapshots[version_n], d)
+            if version_n:
+                self.assertEqual(snapshots[version_n - 1],
+                                 d.lookup_version(version_n - 1))
+
+    def test_intern_values(self):
+        config1 = {'mode': 'a', 'levels': [1, 2, 3]}
+        config2 = {'mode': 'b', 'levels': [1, 2]}
+        d = VersionedDict(config=deepcopy(config1), intern_values=True)
+        d.forward_version()
+        d['config'] = deepcopy(config2)
+        d.forward_version()
+        d['config'] = deepcopy(config1)
+        d['other'] = deepcopy(config1)
+        d.forward_version()
+        stats = d.archive_stats()
+        self.assertEqual(2, stats['pool_values'])
+        self.assertEqual(2, stats['pool_hits'])
+        self.assertEqual(2, stats['pool_misses'])
+        self.assertEqual(0.5, stats['pool_hit_rate'])
+        self.assertTrue(stats['pool_bytes_saved'] > 0)
+        self.assertTrue(d.lookup_value('config', 0) is
+                        d.lookup_value('config', 2))
+        self.assertTrue(d.lookup_value('config', 2) is
+                        d.lookup_value('other', 2))
+        self.assertFalse(d['config'] is d.lookup_value('config', 2))
+        for copied in (deepcopy(d), pickle.loads(pickle.dumps(d))):
+            self.assertTrue(copied.lookup_value('config', 0) is
+                            copied.lookup_value('config', 2))
+            self.assertEqual(2, copied.rewind_version())
+            self.assertEqual(2, copied.archive_stats()['pool_values'])
+            self.assertEqual(1, copied.rewind_version())
+            self.assertEqual(1, copied.archive_stats()['pool_values'])
+            self.assertEqual(0, copied.rewind_version())
+            self.assertEqual(0, copied.archive_stats()['pool_values'])
+        self.assertEqual(2, d.rewind_version())
+        self.assertEqual(2, d.archive_stats()['pool_values'])
+        self.assertEqual(1, d.rewind_version())
+        self.assertEqual(1, d.archive_stats()['pool_values'])
+        self.assertEqual(dict(config=config2), d)
+        self.assertEqual(0, d.rewind_version())
+        self.assertEqual(dict(config=config1), d)
+        self.assertEqual(0, d.archive_stats()['pool_values'])
+        self.assertFalse('pool_values' in VersionedDict().archive_stats())
+
+    def test_log(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'history.log')
+            d = VersionedDict.create(path, a=1, b=[2])
+            with self.assertRaises(FileExistsError):
+                VersionedDict.create(path)
+            snapshots = []
+            for i in range(12):
+                snapshots.append(deepcopy(dict(d)))
+                d.forward_version()
+                d['b'] = d['b'] + [i]
+                d['k%i' % (i % 3)] = i
+                if i % 4 == 3:
+                    del d['a']
+                elif i % 4 == 0:
+                    d['a'] = i
+            size = d.archive_stats()['log_bytes']
+            self.assertEqual(11, d.rewind_version())
+            self.assertTrue(d.archive_stats()['log_bytes'] < size)
+            self.assertEqual(snapshots[11], d)
+            self.assertEqual(12, d.forward_version())
+            snapshots.append(deepcopy(dict(d)))
+            with open(path, 'ab') as log_file:
+                log_file.write(b'\0' * 20)
+            with self.assertRaises(TypeError):
+                VersionedDict.open(path, x=1)
+            d2 = VersionedDict.open(path, checkpoint_interval=4)
+            self.assertEqual(12, d2.version_number)
+            self.assertEqual(snapshots[12], d2)
+            for version_n, snapshot in enumerate(snapshots):
+                self.assertEqual(snapshot, d2.lookup_version(version_n))
+                self.assertEqual(snapshot, d.lookup_version(version_n))
+            self.assertEqual((dict(a=4), {}, dict(b=snapshots[5]['b'], k1=4)),
+                             d2.diff_pair(4, 5))
+            d2['c'] = 3
+            self.assertEqual(13, d2.forward_version())
+            self.assertEqual(12, d2.rewind_version())
+            self.assertEqual(11, d2.rewind_version())
+            self.assertEqual(snapshots[11], d2)
+            d3 = VersionedDict.open(path)
+            self.assertEqual(11, d3.version_number)
+            self.assertEqual(snapshots[10], d3)
+            for copied in (deepcopy(d3), pickle.loads(pickle.dumps(d3))):
+                self.assertEqual(snapshots[10], copied)
+                self.assertEqual(snapshots[4], copied.lookup_version(4))
+            with open(path, 'wb') as log_file:
+                log_file.write(b'something else')
+            with self.assertRaises(ValueError):
+                VersionedDict.open(path)
+            other_path = os.path.join(tmp_dir, 'other.log')
+            self.assertEqual(dict(path=other_path),
+                             VersionedDict(path=other_path))
+            self.assertFalse(os.path.exists(other_path))
+            with self.assertRaises(ValueError):
+                VersionedDict.create(other_path, intern_values=True)
+            with self.assertRaises(ValueError):
+                VersionedDict.create(other_path, concurrent=True)
+            self.assertFalse(os.path.exists(other_path))
+            d = VersionedDict.create(other_path)
+            for i in range(10):
+                d['v'] = bytes([i]) * 10000
+                d.forward_version()
+            self.assertTrue(d.archive_stats()['log_bytes'] < 11 * 10000)
+            d = VersionedDict.open(other_path)
+            self.assertEqual(({}, {}, {'v': bytes([7]) * 10000}),
+                             d.diff_pair(3, 7))
+            self.assertEqual(({}, {}, {'v': bytes([3]) * 10000}),
+                             d.diff_pair(7, 3, reverse=True))
+
+    def test_lookup_values(self):
+        d = VersionedDict(checkpoint_interval=3)
+        for i in range(10):
+            d['k%i' % (i % 4)] = i
+            if i % 3 == 2:
+                d.pop('k%i' % ((i + 1) % 4), None)
+            d.forward_version()
+        d['k0'] = 'current'
+        keys = ['k0', 'k1', 'k3', 'x']
+        versions = [9, 2, 10, 5, 0]
+        table = d.lookup_values(keys, versions)
+        rows = d.lookup_values(keys, versions, dense=True, missing=None)
+        for key, row in zip(keys, rows):
+            for version_n, value in zip(versions, row):
+                try:
+                    expected = d.lookup_value(key, version_n=version_n)
+                except KeyError:
+                    self.assertFalse(version_n in table[key])
+                    self.assertEqual(None, value)
+                else:
+                    self.assertEqual(expected, table[key][version_n])
+                    self.assertEqual(expected, value)
+        self.assertEqual('current', table['k0'][10])
+        self.assertEqual([[MISSING]], d.lookup_values(['x'], [1], dense=True))
+        with self.assertRaises(VersionedDictInvalidVersionError):
+            d.lookup_values(keys, [11])
+
+    def test_iter_versions(self):
+        d = VersionedDict()
+        self.assertEqual([dict()], [dict(m) for m in d.iter_versions()])
+        self.assertEqual([], list(d.key_history('a')))
+        d['a'] = 1
+        self.assertEqual([(0, 1)], list(d.key_history('a')))
+        snapshots = []
+        for i in range(8):
+            snapshots.append(dict(d))
+            d.forward_version()
+            d['k%i' % (i % 3)] = i
+            if i % 3 == 1:
+                d.pop('a', None)
+            elif i % 3 == 2:
+                d['a'] = i
+        snapshots.append(dict(d))
+        self.assertEqual(snapshots,
+                         [dict(m) for m in d.iter_versions()])
+        self.assertEqual(snapshots[3:6],
+                         [dict(m) for m in d.iter_versions(3, 6)])
+        self.assertEqual(snapshots[8:],
+                         [dict(m) for m in d.iter_versions(8)])
+        steps = list(d.iter_versions(deltas=True))
+        self.assertEqual(list(range(9)), [step[0] for step in steps])
+        self.assertEqual((0, dict(a=1), {}, {}), steps[0])
+        self.assertEqual((2, dict(k1=1), dict(a=1), {}), steps[2])
+        self.assertEqual((3, dict(a=2, k2=2), {}, {}), steps[3])
+        self.assertEqual((8, {}, dict(a=5), dict(k1=7)), steps[8])
+        self.assertEqual([(0, 1), (2, DELETED), (3, 2), (5, DELETED),
+                          (6, 5), (8, DELETED)], list(d.key_history('a')))
+        self.assertEqual([(2, 1), (5, 4), (8, 7)],
+                         list(d.key_history('k1')))
+        with self.assertRaises(VersionedDictInvalidVersionError):
+            d.iter_versions(0, 10)
+        with self.assertRaises(VersionedDictInvalidVersionError):
+            d.iter_versions(0, '3')
+        with self.assertRaises(VersionedDictInvalidVersionError):
+            d.iter_versions(-1)
+
+    def test_compaction(self):
+        d = VersionedDict(checkpoint_interval=2)
+        snapshots = []
+        for i in range(9):
+            d['a'] = i
+            d['k%i' % (i % 3)] = i
+            snapshots.append(dict(d))
+            d.forward_version()
+        with self.assertRaises(ValueError):
+            d.squash(2, 9)
+        with self.assertRaises(ValueError):
+            d.prune_before(9)
+        self.assertEqual(2, d.squash(2, 5))
+        for version_n in (3, 4):
+            self.assertFalse(d.version_number_valid(version_n))
+            with self.assertRaises(VersionedDictInvalidVersionError) as cm:
+                d.lookup_value('a', version_n)
+            self.assertTrue(cm.exception.compacted)
+            self.assertIn('compacted', str(cm.exception))
+        with self.assertRaises(VersionedDictInvalidVersionError) as cm:
+            d.lookup_version(10)
+        self.assertFalse(cm.exception.compacted)
+        self.assertEqual(snapshots[5], d.lookup_version(5))
+        self.assertEqual(({}, {}, dict(a=5, k0=3, k1=4, k2=5)),
+                         d.diff_previous(6))
+        self.assertEqual(3, d.prune_before(5))
+        self.assertEqual([5, 6, 7, 8, 9],
+                         [v for v in range(10) if d.version_number_valid(v)])
+        for version_n in range(5, 9):
+            self.assertEqual(snapshots[version_n], d.lookup_version(version_n))
+        self.assertEqual([(5, 5), (6, 6), (7, 7), (8, 8)],
+                         list(d.key_history('a')))
+        self.assertEqual(snapshots[5:] + [dict(d)],
+                         [dict(m) for m in d.iter_versions(5)])
+        self.assertEqual(dict(d.archive_stats(), versions=4, compacted=5),
+                         d.archive_stats())
+        self.assertEqual(8, d.rewind_version())
+        self.assertEqual(snapshots[8], d)
+        d = VersionedDict(retention=RetentionPolicy(keep_last=2, keep_every=3))
+        for i in range(10):
+            d['a'] = i
+            d.forward_version()
+        self.assertEqual([0, 3, 6, 8, 9, 10],
+                         [v for v in range(11) if d.version_number_valid(v)])
+        self.assertEqual(6, d.lookup_value('a', 6))
+        self.assertEqual(dict(a=8), d.lookup_version(8))
+        d = VersionedDict(retention=RetentionPolicy(max_bytes=2000))
+        for i in range(100):
+            d['k%i' % (i % 5)] = 'x' * 100 + str(i)
+            d.forward_version()
+            self.assertTrue(d.archive_stats()['archive_bytes'] <= 2000 or
+                            d.archive_stats()['versions'] == 1)
+        self.assertEqual(d, d.lookup_version(99))
+        with self.assertRaises(ValueError):
+            RetentionPolicy(keep_last=0)
+        with self.assertRaises(ValueError):
+            VersionedDict(retention=3)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'versions.log')
+            d = VersionedDict.create(
+                path, retention=RetentionPolicy(keep_last=2))
+            for i in range(7):
+                d['a'] = i
+                d['k%i' % i] = i
+                d.forward_version()
+            self.assertEqual([4, 5, 6], [v for v in range(7)
+                                         if d.version_number_valid(v)])
+            self.assertEqual(1, d.squash(4, 6))
+            d = VersionedDict.open(path)
+            self.assertEqual(7, d.version_number)
+            self.assertFalse(d.version_number_valid(5))
+            self.assertEqual(4, d.lookup_value('a', 4))
+            self.assertEqual(dict(a=6, **{'k%i' % i: i for i in range(7)}),
+                             d.lookup_version(6))
+
+    def test_fork(self):
+        d = VersionedDict(a=0)
+        self.assertIsNone(d.fork().common_ancestor(d))
+        for i in range(1, 6):
+            d.forward_version()
+            d['a'] = i
+            d['b%i' % i] = i
+        f = d.fork()
+        self.assertEqual([f], d.branches())
+        self.assertEqual(d, f)
+        self.assertEqual(5, f.version_number)
+        self.assertEqual(dict(a=2, b1=1, b2=2), f.lookup_version(2))
+        self.assertEqual(0, f.archive_stats()['versions'])
+        self.assertEqual(5, f.archive_stats()['shared_versions'])
+        f['a'] = 'f'
+        del f['b1']
+        f.forward_version()
+        f['c'] = 'f'
+        d['a'] = 'd'
+        d.forward_version()
+        self.assertEqual(4, f.common_ancestor(d))
+        self.assertEqual(({'b1': 1}, {'c': 'f'}, {'a': 'd'}),
+                         f.diff_branch(d))
+        self.assertEqual(dict(a='f', b2=2, b3=3, b4=4, b5=5),
+                         f.lookup_version(5))
+        self.assertEqual([(0, 0), (1, 1), (2, 2), (3, 3), (4, 4), (5, 'f')],
+                         list(f.key_history('a')))
+        self.assertEqual(dict(a='d', b1=1, b2=2, b3=3, b4=4, b5=5),
+                         d.lookup_version(5))
+        view = f.view(3)
+        d.rewind_version()
+        d.rewind_version()
+        d.prune_before(2)
+        self.assertFalse(d.version_number_valid(1))
+        self.assertEqual(dict(a=1, b1=1), f.lookup_version(1))
+        self.assertEqual(dict(a=3, b1=1, b2=2, b3=3), dict(view))
+        self.assertEqual(6, f.archive_stats()['versions'])
+        self.assertEqual(3, f.common_ancestor(d))
+        d.rewind_version()
+        self.assertEqual(2, f.common_ancestor(d))
+        g = f.fork()
+        self.assertEqual([f, g], [f] + f.branches())
+        g.rewind_version()
+        self.assertEqual(dict(a='f', b2=2, b3=3, b4=4, b5=5), g)
+        self.assertEqual(dict(f.lookup_version(5)), g)
+
+    def test_cache(self):
+        d = VersionedDict(cache_size=2)
+        for i in range(6):
+            d['k%i' % i] = i
+            d.forward_version()
+        version = d.lookup_version(3)
+        self.assertEqual(dict(k0=0, k1=1, k2=2, k3=3), version)
+        version['x'] = 1
+        self.assertEqual(dict(k0=0, k1=1, k2=2, k3=3), d.lookup_version(3))
+        self.assertEqual({'k0', 'k1', 'k2', 'k3'}, d.keys_in_version(3))
+        stats = d.archive_stats()
+        self.assertEqual((2, 2, 1), (stats['cache_hits'],
+                                     stats['cache_misses'],
+                                     stats['cache_entries']))
+        d.keys_in_version(4)
+        d.keys_in_version(5)
+        self.assertEqual(2, d.archive_stats()['cache_entries'])
+        d.rewind_version()
+        d['k5'] = 'new'
+        d.forward_version()
+        self.assertEqual({'k0', 'k1', 'k2', 'k3', 'k4', 'k5'},
+                         d.keys_in_version(5))
+        self.assertEqual('new', d.lookup_version(5)['k5'])
+        d.squash(3, 5)
+        with self.assertRaises(VersionedDictInvalidVersionError):
+            d.keys_in_version(4)
+        d = VersionedDict(cache_bytes=1000)
+        for i in range(100):
+            d['k%i' % i] = i
+            d.forward_version()
+        for i in range(100):
+            self.assertEqual(i + 1, len(d.lookup_version(i)))
+        self.assertLessEqual(d.archive_stats()['cache_bytes'], 1000)
+        d = VersionedDict(cache_size=3)
+        snapshots = []
+        for i in range(40):
+            d['k%i' % (i % 7)] = i
+            snapshots.append(dict(d))
+            d.forward_version()
+        for version_n in (30, 10, 20, 25, 35, 12, 5, 28, 39, 21, 0, 11):
+            self.assertEqual(snapshots[version_n],
+                             d.lookup_version(version_n))
+        self.assertEqual(3, d.archive_stats()['cache_entries'])
+        with self.assertRaises(ValueError):
+            VersionedDict(cache_size=0)
+
+    def test_compression(self):
+        for compression in ('zlib', 'lzma', 'bz2'):
+            d = VersionedDict(compression=compression, compression_window=2)
+            snapshots = []
+            for i in range(8):
+                d['text'] = 'lorem ipsum ' * 100 + str(i)
+                d['k%i' % (i % 3)] = [i]
+                snapshots.append(deepcopy(dict(d)))
+                d.forward_version()
+            stats = d.archive_stats()
+            self.assertEqual(6, stats['compressed_versions'])
+            self.assertLess(stats['compressed_bytes'],
+                            stats['uncompressed_bytes'])
+            for version_n, snapshot in enumerate(snapshots):
+                self.assertEqual(snapshot, d.lookup_version(version_n))
+                self.assertEqual(set(snapshot),
+                                 d.keys_in_version(version_n))
+            self.assertEqual([1], d.lookup_value('k1', 2))
+            self.assertEqual(({'k2': [5]}, {},
+                              {'text': snapshots[5]['text'],
+                               'k0': [3], 'k1': [4]}),
+                             d.diff_pair(1, 5))
+            d.squash(1, 5)
+            self.assertEqual(snapshots[5], d.lookup_version(5))
+            for _ in range(3):
+                d.rewind_version()
+            self.assertEqual(snapshots[5], d)
+        d = VersionedDict(compression='zlib', compression_window=1)
+        for i in range(16):
+            d['k%i' % i] = 'lorem ipsum ' * 10
+            d.forward_version()
+        with mock.patch.object(zlib, 'decompress',
+                               wraps=zlib.decompress) as decompress:
+            self.assertEqual(16, len(d.keys_in_version(15)))
+            self.assertEqual(15, len(d.keys_in_version(14)))
+        self.assertEqual(0, decompress.call_count)
+        with self.assertRaises(ValueError):
+            VersionedDict(compression='gzip')
+        with self.assertRaises(ValueError):
+            VersionedDict(compression='zlib', intern_values=True)
+
+    def test_instrumentation(self):
+        events = []
+        d = VersionedDict(a=1, instrument_hook=lambda name, details:
+                          events.append((name, details)))
+        d.forward_version()
+        d['a'] = 2
+        d['b'] = [3]
+        d.forward_version()
+        self.assertEqual(1, d.lookup_value('a', 0))
+        self.assertEqual({'a'}, d.keys_in_version(0))
+        stats = d.archive_stats()
+        self.assertEqual(2, stats['calls']['forward_version'])
+        self.assertEqual(1, stats['calls']['lookup_value'])
+        self.assertEqual(1, stats['calls']['compare'])
+        self.assertEqual(1, stats['calls']['reconstruct_keys'])
+        self.assertGreater(stats['calls']['copy'], 0)
+        self.assertGreater(stats['seconds']['forward_version'], 0)
+        self.assertEqual({0: 1, 1: 2}, stats['delta_changes'])
+        self.assertEqual([0, 1], sorted(stats['delta_bytes']))
+        archived = [details for name, details in events
+                    if name == 'archive']
+        self.assertEqual([0, 1], [details['version']
+                                  for details in archived])
+        self.assertEqual(stats['delta_bytes'][1], archived[1]['bytes'])
+        self.assertIn('lookup_value', [name for name, _ in events])
+        d.rewind_version()
+        self.assertEqual({0: 1}, d.archive_stats()['delta_changes'])
+        fork = d.fork()
+        fork.forward_version()
+        self.assertEqual(1, fork.archive_stats()['calls']['forward_version'])
+        self.assertEqual(2, d.archive_stats()['calls']['forward_version'])
+        copied = deepcopy(d)
+        copied['a'] = 5
+        copied.forward_version()
+        self.assertEqual(1, d.version_number)
+        self.assertEqual(2, copied.version_number)
+        self.assertEqual(2, d.archive_stats()['calls']['forward_version'])
+        self.assertEqual(3,
+                         copied.archive_stats()['calls']['forward_version'])
+        del fork
+        self.assertEqual([], d.branches())
+        self.assertNotIn('calls', VersionedDict().archive_stats())
+        self.assertNotIn('lookup_value', vars(VersionedDict()))
+        d = VersionedDict(instrument=True)
+        for i in range(4):
+            d['v'] = bytes([i]) * 10000
+            d.forward_version()
+        sizes = d.archive_stats()['delta_bytes']
+        self.assertTrue(max(sizes.values()) < 1.1 * min(sizes.values()))
+        with self.assertRaises(ValueError):
+            VersionedDict(instrument_hook=1)
+
+    def test_fingerprints(self):
+        comparisons = []
+
+        class Document(dict):
+            def __eq__(self, other):
+                comparisons.append(self)
+                return dict.__eq__(self, other)
+
+            def __ne__(self, other):
+                return not self == other
+
+        d = VersionedDict(full_diff=True, fingerprints=True,
+                          hasher=lambda value: value.get('rev'))
+        d['doc'] = Document(rev=1, text='a' * 1000)
+        d.forward_version()
+        for _ in range(3):
+            d.forward_version()
+        self.assertEqual([], comparisons)
+        self.assertEqual({}, d.diff_pair(0, 3)[2])
+        d['doc'] = Document(rev=2, text='b')
+        d.forward_version()
+        self.assertEqual(1, len(comparisons))
+        self.assertEqual('b', d.lookup_value('doc', 4)['text'])
+        self.assertEqual({'doc': {'rev': 2, 'text': 'b'}},
+                         d.diff_pair(3, 4)[2])
+        d = VersionedDict(fingerprints=True)
+        d['a'] = {'x': 1, 'y': 2}
+        d['b'] = [1]
+        d.forward_version()
+        d['a'] = {'y': 2, 'x': 1}
+        d['b'] = [2]
+        d.forward_version()
+        self.assertEqual(({}, {}, {'b': [2]}), d.diff_pair(0, 1))
+        d['b'] = [1]
+        self.assertEqual(1, d.rewind_version())
+        self.assertEqual([2], d['b'])
+        d = VersionedDict(doc={'n': 1}, fingerprints=True)
+        d.forward_version()
+        d['doc']['n'] = 2
+        d['doc'] = d['doc']
+        d.forward_version()
+        self.assertEqual({'doc': {'n': 1}}, d.lookup_version(0))
+        self.assertEqual({'doc': {'n': 2}}, d.lookup_version(1))
+        hashed = []
+        d = VersionedDict(fingerprints=True, hasher=hashed.append,
+                          copy_strategy='none')
+        doc = Document(rev=1)
+        d['doc'] = doc
+        d.forward_version()
+        del comparisons[:]
+        for _ in range(3):
+            d['doc'] = doc
+            d.forward_version()
+        self.assertEqual([], hashed)
+        self.assertEqual([], comparisons)
+        d['doc'] = Document(rev=1)
+        d.forward_version()
+        self.assertEqual(1, len(comparisons))
+        with self.assertRaises(ValueError):
+            VersionedDict(fingerprints=True, hasher='md5')
+
+    def test_concurrent(self):
+        d = VersionedDict(concurrent=True, cache_size=16, full_diff=True,
+                          retention=RetentionPolicy(keep_last=30,
+                                                    keep_every=4))
+        writing = threading.Event()
+        writing.set()
+        errors = []
+        reads = []
+
+        def write():
+            rnd = random.Random(0)
+            try:
+                for step in range(300):
+                    for _ in range(3):
+                        d['k%i' % rnd.randrange(20)] = rnd.randrange(100)
+                    d['sum'] = sum(value for key, value in d.items()
+                                   if key.startswith('k'))
+                    d['version'] = d.version_number
+                    d.forward_version()
+                    if step % 7 == 6:
+                        d.rewind_version()
+                    if step % 50 == 49:
+                        d.squash(d.version_number - 20,
+                                 d.version_number - 10)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                writing.clear()
+
+        def read(index):
+            rnd = random.Random(index)
+            count = 0
+            try:
+                while writing.is_set() or not count:
+                    version_n = d.version_number - 5
+                    if version_n < 1:
+                        continue
+                    version_n = rnd.randrange(version_n)
+                    try:
+                        archived = d.lookup_version(version_n)
+                        value = d.lookup_value('version', version_n)
+                    except VersionedDictInvalidVersionError:
+                        continue
+                    self.assertEqual(version_n, archived['version'])
+                    self.assertEqual(version_n, value)
+                    self.assertEqual(archived['sum'],
+                                     sum(value for key, value
+                                         in archived.items()
+                                         if key.startswith('k')))
+                    count += 1
+            except Exception as error:
+                errors.append(error)
+            reads.append(count)
+
+        threads = [threading.Thread(target=read, args=(index,))
+                   for index in range(4)]
+        threads.append(threading.Thread(target=write))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual(4, len(reads))
+        self.assertTrue(all(reads))
+        self.assertEqual(258, d.version_number)
+        for copied in (deepcopy(d), pickle.loads(pickle.dumps(d))):
+            copied.rewind_version()
+            self.assertEqual(257, copied.version_number)
+            self.assertEqual(256, copied.lookup_value('version', 256))
+            self.assertEqual(258, d.version_number)
+        with self.assertRaises(ValueError):
+            VersionedDict(concurrent=True, compression='zlib')
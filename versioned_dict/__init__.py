@@ -40,16 +40,20 @@ Added keys and their values, deleted keys and their values and modified keys
 and their values are are stored.
 
 Limitations::
-  * If rewinding of versions happens very often, this approach
-    lacks performance, in particular when there are many versions.
   * When archiving a version, the difference is examined only on the highest
     level: In case of a common key the substructure of the values is not
     examined. (That would somewhat correspond to a differential backup.)
+    With *nested_deltas=True* large dict, list and set values are diffed
+    recursively, though.
   * When rewinding or looking up a specific archived version, the item
     ordering is usually not preserved (as is not to be expected from a
     :class:`dict`).
-  * keys are assumed to objects of type :class:`str`. We do deep-copy keys
-    when archiving, but this is not tested.
+  * keys are assumed to objects of type :class:`str`. We do copy keys
+    when archiving (like values, see *copy_strategy*), but this is not tested.
+  * Changes are tracked through the mutating methods of the dict, so only
+    keys which have been set or deleted since the last archived version are
+    diffed. Values which are mutated in place are not noticed, unless
+    the instance has been created with *full_diff=True*.
 
 Example use case: Version 0 of the dictionary has just one key containing the
 fulltext of a longer document. Other versions add or delete keys containing
@@ -57,7 +61,964 @@ intermediate results in analyzing the document, which may themselves be of
 considerable size, but which don't change the document.
 """
 
-from copy import deepcopy
+import copyreg
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+import sys
+import threading
+import weakref
+import zlib
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, namedtuple
+from collections.abc import Mapping
+from copy import copy, deepcopy
+from functools import wraps
+from time import perf_counter
+from types import MappingProxyType
+
+try:
+    import bz2
+except ImportError:  # Python built without bz2 support
+    bz2 = None
+try:
+    import lzma
+except ImportError:  # Python built without lzma support
+    lzma = None
+
+
+__all__ = [
+    'DELETED',
+    'MISSING',
+    'RetentionPolicy',
+    'VersionedDict',
+    'VersionedDictInvalidVersionError',
+    'VersionedDictRewindError',
+    'VersionedDictStaleViewError',
+    'VersionedDictView',
+]
+
+
+_Delta = namedtuple('_Delta', 'addition deletion modification replaced')
+_Delta.__doc__ = """
+The difference of an archived version against the previous one.
+
+*addition* and *modification* map keys to their new values, *deletion*
+maps keys to their old values and *replaced* maps the modified keys to
+their old values, such that the difference can be inverted.
+
+*replaced* is not stored in compressed records and log files, since the
+old values are archived already; it is empty in the deltas read back
+from them.
+"""
+
+
+_PackedDelta = namedtuple('_PackedDelta', 'keys data codec size')
+_PackedDelta.__doc__ = """
+A compressed :class:`_Delta`.
+
+*keys* holds lists of the added, deleted and modified keys, *data* the
+pickle of the delta (without *replaced*) compressed with the codec named
+*codec* and *size* the length of the uncompressed pickle.
+"""
+
+
+class _Sentinel:
+
+    """
+    A unique marker object with a readable representation.
+    """
+
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+    def __reduce__(self):
+        return self.name
+
+
+MISSING = _Sentinel('MISSING')  # marks an absent key
+DELETED = _Sentinel('DELETED')  # marks the deletion of a key
+
+
+_ATOMIC_TYPES = frozenset((type(None), bool, int, float, complex, str, bytes,
+                           range, type(Ellipsis)))
+
+
+def _is_immutable(obj):
+    """
+    Return whether *obj* is known to be immutable.
+
+    This holds for atomic types like :class:`str` and :class:`int` and for
+    tuples and frozensets containing only immutable objects.
+    """
+    if type(obj) in _ATOMIC_TYPES:
+        return True
+    if type(obj) in (tuple, frozenset):
+        return all(_is_immutable(item) for item in obj)
+    return False
+
+
+def _pickle_copy(obj):
+    """
+    Return a copy of *obj* made by a pickle round trip.
+    """
+    return pickle.loads(pickle.dumps(obj, protocol=5))
+
+
+def _no_copy(obj):
+    """
+    Return *obj* itself.
+    """
+    return obj
+
+
+_COPY_STRATEGIES = {
+    'deep': deepcopy,
+    'shallow': copy,
+    'none': _no_copy,
+    'pickle': _pickle_copy,
+}
+
+
+def _deep_sizeof(obj, limit=None):
+    """
+    Return the estimated size of *obj* in bytes, including its items.
+
+    Items of dicts, lists, tuples and sets are counted recursively, every
+    object only once. If *limit* is given, stop counting once it is reached.
+    """
+    size = 0
+    seen = set()
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if limit is not None and size >= limit:
+            break
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+    return size
+
+
+def _delta_sizeof(record):
+    """
+    Return the estimated size of an archived *record* in bytes.
+
+    The old values in *replaced* of a :class:`_Delta` are not counted,
+    since they are held by an earlier record.
+    """
+    if type(record) is _Delta:
+        record = record[:3]
+    return _deep_sizeof(record)
+
+
+_NESTED_TYPES = (dict, list, set)
+
+
+class _Patch:
+
+    """
+    A path-based difference of a nested value (a dict, list or set).
+
+    *ops* is a list of operations, each starting with its kind and
+    the path (a tuple of keys and indexes) of the affected item:
+
+      * ('assign', path, value): set the item at *path* to *value*
+      * ('remove', path): delete the item at *path*
+      * ('splice', path, start, stop, items): replace a slice of the list
+        at *path* by *items*
+      * ('sets', path, added, removed): add and remove elements of the set
+        at *path*
+    """
+
+    __slots__ = ('ops',)
+
+    def __init__(self, ops):
+        self.ops = ops
+
+    def apply(self, value):
+        """
+        Return *value* with this difference applied.
+
+        *value* is not altered; only the containers along the paths of
+        the operations are copied, all other items are shared.
+        """
+        copied = {(): copy(value)}
+
+        def container(path):
+            if path not in copied:
+                parent = container(path[:-1])
+                parent[path[-1]] = copied[path] = copy(parent[path[-1]])
+            return copied[path]
+
+        for op in self.ops:
+            kind, path = op[0], op[1]
+            if kind == 'assign':
+                container(path[:-1])[path[-1]] = op[2]
+            elif kind == 'remove':
+                del container(path[:-1])[path[-1]]
+            elif kind == 'splice':
+                container(path)[op[2]:op[3]] = op[4]
+            else:
+                items = container(path)
+                items -= op[3]
+                items |= op[2]
+        return copied[()]
+
+    @classmethod
+    def diff(cls, old, new, copy_obj):
+        """
+        Return the difference between the nested values *old* and *new*.
+
+        *old* and *new* must be of the same type, one of
+        :data:`_NESTED_TYPES`. New items are copied using *copy_obj*.
+        """
+        ops = []
+        cls.__diff_items(old, new, (), copy_obj, ops)
+        return cls(ops)
+
+    @classmethod
+    def __diff_items(cls, old, new, path, copy_obj, ops):
+        if type(old) is dict:
+            for key in old.keys() - new.keys():
+                ops.append(('remove', path + (key,)))
+            for key, value in new.items():
+                if key in old:
+                    cls.__diff_value(old[key], value, path + (key,),
+                                     copy_obj, ops)
+                else:
+                    ops.append(('assign', path + (key,), copy_obj(value)))
+        elif type(old) is list:
+            if len(old) == len(new):
+                for index, (old_item, item) in enumerate(zip(old, new)):
+                    cls.__diff_value(old_item, item, path + (index,),
+                                     copy_obj, ops)
+                return
+            start = 0
+            max_common = min(len(old), len(new))
+            while start < max_common and (old[start] is new[start] or
+                                          old[start] == new[start]):
+                start += 1
+            end = 0
+            while end < max_common - start and \
+                    (old[-end - 1] is new[-end - 1] or
+                     old[-end - 1] == new[-end - 1]):
+                end += 1
+            ops.append(('splice', path, start, len(old) - end,
+                        [copy_obj(item)
+                         for item in new[start:len(new) - end]]))
+        else:
+            added = new - old
+            removed = old - new
+            if added or removed:
+                ops.append(('sets', path, added, removed))
+
+    @classmethod
+    def __diff_value(cls, old, new, path, copy_obj, ops):
+        if old is new:
+            return
+        if type(old) is type(new) and type(new) in _NESTED_TYPES:
+            cls.__diff_items(old, new, path, copy_obj, ops)
+        elif old != new:
+            ops.append(('assign', path, copy_obj(new)))
+
+
+def _default_digest(value):
+    """
+    Return a key identifying the content of *value*.
+
+    Strings and bytes are identified by themselves, other values by
+    a digest of their pickle. If *value* cannot be pickled, return None.
+    """
+    if type(value) in (str, bytes):
+        return type(value), value
+    try:
+        data = pickle.dumps(value, protocol=5)
+    except Exception:
+        return None
+    return hashlib.blake2b(data).digest()
+
+
+_CODECS = {name: module for name, module in
+           (('zlib', zlib), ('lzma', lzma), ('bz2', bz2))
+           if module is not None}
+
+
+def _copy_function(copy_strategy):
+    """
+    Return a function copying keys and values for *copy_strategy*.
+
+    *copy_strategy* is one of the names in :data:`_COPY_STRATEGIES` or
+    a callable. The returned function does not copy immutable objects.
+    """
+    if callable(copy_strategy):
+        copy_obj = copy_strategy
+    elif copy_strategy in _COPY_STRATEGIES:
+        copy_obj = _COPY_STRATEGIES[copy_strategy]
+    else:
+        raise ValueError('copy_strategy must be one of %s or a callable'
+                         % ', '.join(map(repr, _COPY_STRATEGIES)))
+    if copy_obj is _no_copy:
+        return copy_obj
+    return _MutableCopier(copy_obj)
+
+
+class _MutableCopier:
+
+    """
+    A function copying objects with *copy_obj*, except immutable ones.
+
+    Unlike a closure, it can be pickled along with the
+    :class:`VersionedDict` using it.
+    """
+
+    def __init__(self, copy_obj):
+        self.copy_obj = copy_obj
+
+    def __call__(self, obj):
+        if _is_immutable(obj):
+            return obj
+        return self.copy_obj(obj)
+
+
+class _DeltaList(list):
+
+    """
+    The in-memory archive: a list of :class:`_Delta` records.
+
+    Records may be compressed with :meth:`pack`; indexing returns them
+    decompressed, with the latest few decompressed records cached.
+    Iterating yields the stored records as they are. The version numbers
+    of the records are kept by :class:`VersionedDict`.
+    """
+
+    CACHE_SIZE = 8
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.__cache = OrderedDict()   # id of record -> (record, delta)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.__unpack(record)
+                    for record in super().__getitem__(index)]
+        return self.__unpack(super().__getitem__(index))
+
+    def __unpack(self, record):
+        """
+        Return *record* decompressed, if it is a :class:`_PackedDelta`.
+        """
+        if type(record) is not _PackedDelta:
+            return record
+        entry = self.__cache.get(id(record))
+        if entry is not None and entry[0] is record:
+            self.__cache.move_to_end(id(record))
+            return entry[1]
+        data = _CODECS[record.codec].decompress(record.data)
+        delta = _Delta(*pickle.loads(data), {})
+        self.__cache[id(record)] = (record, delta)
+        if len(self.__cache) > self.CACHE_SIZE:
+            self.__cache.popitem(last=False)
+        return delta
+
+    def keys(self, index):
+        """
+        Return the added, deleted and modified keys of delta *index*.
+        """
+        record = super().__getitem__(index)
+        if type(record) is _PackedDelta:
+            return record.keys
+        return (record.addition.keys(), record.deletion.keys(),
+                record.modification.keys())
+
+    def records(self, start, stop):
+        """
+        Return a list of the stored records from *start* to *stop*.
+        """
+        return super().__getitem__(slice(start, stop))
+
+    def pack(self, index, codec):
+        """
+        Compress record *index* with the codec named *codec*.
+
+        Records which are compressed already or cannot be pickled are
+        left as they are.
+        """
+        record = super().__getitem__(index)
+        if type(record) is _PackedDelta:
+            return
+        try:
+            data = pickle.dumps(tuple(record[:3]), protocol=5)
+        except Exception:
+            return
+        keys = (list(record.addition), list(record.deletion),
+                list(record.modification))
+        self[index] = _PackedDelta(keys, _CODECS[codec].compress(data),
+                                   codec, len(data))
+
+    def packed_sizes(self):
+        """
+        Return the number of compressed records, their size and their
+        uncompressed size in bytes.
+        """
+        packed = [record for record in self
+                  if type(record) is _PackedDelta]
+        return (len(packed), sum(len(record.data) for record in packed),
+                sum(record.size for record in packed))
+
+    def append(self, delta, version_n=None):
+        """
+        Append *delta*; *version_n* is ignored.
+        """
+        super().append(delta)
+
+    def replace(self, runs):
+        """
+        Replace runs of records by single records.
+
+        *runs* is a sorted list of tuples (start, stop, delta, version
+        number); the records from start to stop (exclusive) are replaced
+        by *delta*.
+        """
+        for start, stop, delta, _ in reversed(runs):
+            self[start:stop] = [delta]
+        self.__cache.clear()
+
+
+class _DeltaLog:
+
+    """
+    The on-disk archive: an append-only file of :class:`_Delta` records.
+
+    The file starts with :attr:`MAGIC`. Each record consists of a frame
+    header with the lengths of two pickles and their CRC-32, followed by
+    the pickles: the added, deleted and modified keys together with the
+    version number, and the delta itself (without *replaced*). Records are
+    read lazily through :mod:`mmap`; the keys can be read without
+    unpickling the values.
+    The latest few records read are cached.
+
+    A copy or unpickled log refers to the same file; the memory map and
+    the cache are not copied.
+
+    Supports the part of the list interface used by :class:`VersionedDict`.
+    """
+
+    MAGIC = b'VDLOG01\n'
+    FRAME = struct.Struct('<QQI')
+    CACHE_SIZE = 8
+
+    def __init__(self, path, offsets):
+        self.path = path
+        self.__offsets = offsets   # start offsets of the records and the end
+        self.__mmap = None
+        self.__cache = OrderedDict()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_DeltaLog__mmap'] = None
+        state['_DeltaLog__cache'] = OrderedDict()
+        return state
+
+    @classmethod
+    def create(cls, path):
+        """
+        Create a new log file at *path* and return the log.
+
+        Raise :class:`FileExistsError`, if a non-empty file exists.
+        """
+        with open(path, 'ab') as log_file:
+            if log_file.tell():
+                raise FileExistsError('VersionedDict log %r exists' % path)
+            log_file.write(cls.MAGIC)
+        return cls(path, [len(cls.MAGIC)])
+
+    @classmethod
+    def open(cls, path):
+        """
+        Open the existing log file at *path* and return the log.
+
+        Only the frame headers are read. An incomplete or corrupt last
+        record (from an interrupted write) is cut off; the checksum is
+        verified for the last record only.
+        """
+        with open(path, 'rb') as log_file:
+            if log_file.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise ValueError('%r is not a VersionedDict log' % path)
+            size = os.fstat(log_file.fileno()).st_size
+            offsets = [len(cls.MAGIC)]
+            while offsets[-1] + cls.FRAME.size <= size:
+                keys_size, delta_size, _ = cls.FRAME.unpack(
+                    log_file.read(cls.FRAME.size))
+                end = offsets[-1] + cls.FRAME.size + keys_size + delta_size
+                if not keys_size or not delta_size or end > size:
+                    break
+                log_file.seek(end)
+                offsets.append(end)
+            if len(offsets) > 1:
+                log_file.seek(offsets[-2])
+                _, _, crc = cls.FRAME.unpack(log_file.read(cls.FRAME.size))
+                data = log_file.read(offsets[-1] - offsets[-2] -
+                                     cls.FRAME.size)
+                if zlib.crc32(data) != crc:
+                    del offsets[-1]
+        if offsets[-1] < size:
+            os.truncate(path, offsets[-1])
+        return cls(path, offsets)
+
+    def __len__(self):
+        return len(self.__offsets) - 1
+
+    def __read(self, index, part):
+        """
+        Return the unpickled *part* (0: keys, 1: delta) of record *index*.
+        """
+        start = self.__offsets[index]
+        self.__map()
+        keys_size, delta_size, _ = self.FRAME.unpack_from(self.__mmap,
+                                                          start)
+        start += self.FRAME.size
+        if part:
+            start += keys_size
+        end = start + (delta_size if part else keys_size)
+        return pickle.loads(self.__mmap[start:end])
+
+    def __map(self):
+        """
+        Map the log file into memory, unless it is mapped completely.
+        """
+        if self.__mmap is None or len(self.__mmap) < self.__offsets[-1]:
+            self.__close_mmap()
+            with open(self.path, 'rb') as log_file:
+                self.__mmap = mmap.mmap(log_file.fileno(), 0,
+                                        access=mmap.ACCESS_READ)
+
+    def __close_mmap(self):
+        if self.__mmap is not None:
+            self.__mmap.close()
+            self.__mmap = None
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('delta index out of range')
+        delta = self.__cache.get(index)
+        if delta is None:
+            delta = _Delta(*self.__read(index, 1), {})
+            self.__cache_delta(index, delta)
+        else:
+            self.__cache.move_to_end(index)
+        return delta
+
+    def __cache_delta(self, index, delta):
+        self.__cache[index] = delta
+        if len(self.__cache) > self.CACHE_SIZE:
+            self.__cache.popitem(last=False)
+
+    def records(self, start, stop):
+        """
+        Return a list of the deltas from *start* to *stop*.
+        """
+        return self[start:stop]
+
+    def keys(self, index):
+        """
+        Return the added, deleted and modified keys of record *index*.
+        """
+        if index < 0:
+            index += len(self)
+        delta = self.__cache.get(index)
+        if delta is not None:
+            return (delta.addition.keys(), delta.deletion.keys(),
+                    delta.modification.keys())
+        return self.__read(index, 0)[:3]
+
+    def scan(self):
+        """
+        Iterate over the records, yielding tuples (version number, added
+        keys, deleted keys, modified keys).
+        """
+        for index in range(len(self)):
+            added, deleted, modified, version_n = self.__read(index, 0)
+            yield version_n, added, deleted, modified
+
+    def __encode(self, delta, version_n):
+        """
+        Return the record for *delta* with version number *version_n*.
+        """
+        keys_data = pickle.dumps((list(delta.addition),
+                                  list(delta.deletion),
+                                  list(delta.modification), version_n),
+                                 protocol=5)
+        delta_data = pickle.dumps(tuple(delta[:3]), protocol=5)
+        crc = zlib.crc32(delta_data, zlib.crc32(keys_data))
+        return b''.join((self.FRAME.pack(len(keys_data), len(delta_data),
+                                         crc), keys_data, delta_data))
+
+    def append(self, delta, version_n):
+        """
+        Append a record for *delta* with version number *version_n*.
+        """
+        record = self.__encode(delta, version_n)
+        with open(self.path, 'ab') as log_file:
+            log_file.write(record)
+        self.__offsets.append(self.__offsets[-1] + len(record))
+        self.__cache_delta(len(self) - 1, delta)
+
+    def replace(self, runs):
+        """
+        Replace runs of records by single records, rewriting the log file.
+
+        *runs* is a sorted list of tuples (start, stop, delta, version
+        number); the records from start to stop (exclusive) are replaced
+        by a record for *delta*. The other records are copied unchanged
+        to a new file, which then replaces the log file.
+        """
+        self.__map()
+        offsets = [len(self.MAGIC)]
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as log_file:
+            log_file.write(self.MAGIC)
+            index = 0
+            for start, stop, delta, version_n in \
+                    runs + [(len(self), len(self), None, None)]:
+                for index in range(index, start):
+                    record = self.__mmap[self.__offsets[index]:
+                                         self.__offsets[index + 1]]
+                    log_file.write(record)
+                    offsets.append(offsets[-1] + len(record))
+                if delta is not None:
+                    record = self.__encode(delta, version_n)
+                    log_file.write(record)
+                    offsets.append(offsets[-1] + len(record))
+                index = stop
+        self.__close_mmap()
+        os.replace(temp_path, self.path)
+        self.__offsets = offsets
+        self.__cache.clear()
+
+    def __delitem__(self, index):
+        """
+        Remove the last record, truncating the log file.
+        """
+        if index not in (-1, len(self) - 1):
+            raise IndexError('only the last delta can be removed')
+        self.__cache.pop(len(self) - 1, None)
+        self.__close_mmap()
+        del self.__offsets[-1]
+        os.truncate(self.path, self.__offsets[-1])
+
+    def size(self):
+        """
+        Return the size of the log file in bytes.
+        """
+        return self.__offsets[-1]
+
+    def record_size(self, index):
+        """
+        Return the size of record *index* in bytes.
+        """
+        return self.__offsets[index + 1] - self.__offsets[index]
+
+
+class _LRUCache:
+
+    """
+    A least recently used cache of reconstructed versions and key sets.
+
+    It holds at most *max_entries* entries and at most *max_bytes* bytes
+    of their estimated size; a limit of None means no limit. Counts the
+    hits and misses of :meth:`get`.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()   # key -> (value, size)
+        self.__versions = {}   # kind -> sorted version numbers of entries
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key):
+        """
+        Return the value cached for *key*, or None.
+        """
+        entry = self.__entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.__entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, size, check=None):
+        """
+        Cache *value* with the estimated *size* for *key*.
+
+        Evict the least recently used entries as needed to stay within
+        the limits. If *check* is given, cache only if it returns True.
+        """
+        if check is not None and not check():
+            return
+        self.discard(key)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        self.__entries[key] = (value, size)
+        self.bytes += size
+        insort(self.__versions.setdefault(key[0], []), key[1])
+        while (self.max_entries is not None and
+               len(self.__entries) > self.max_entries) or \
+                (self.max_bytes is not None and self.bytes > self.max_bytes):
+            evicted, (_, evicted_size) = self.__entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.__unlist(evicted)
+
+    def discard(self, key):
+        """
+        Remove the entry for *key*, if there is one.
+        """
+        entry = self.__entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+            self.__unlist(key)
+
+    def __unlist(self, key):
+        """
+        Remove the version number of the removed entry for *key* from the
+        sorted list of its kind.
+        """
+        versions = self.__versions[key[0]]
+        del versions[bisect_left(versions, key[1])]
+
+    def nearest(self, kind, low, high):
+        """
+        Return the key of the latest cached entry of *kind* for a version
+        after *low* up to *high*, or None.
+        """
+        versions = self.__versions.get(kind)
+        if versions:
+            pos = bisect_right(versions, high)
+            if pos and versions[pos - 1] > low:
+                return kind, versions[pos - 1]
+        return None
+
+
+class _SharedLRUCache(_LRUCache):
+
+    """
+    An :class:`_LRUCache` which may be used by several threads at once.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        super().__init__(max_entries, max_bytes)
+        self.__lock = threading.RLock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_SharedLRUCache__lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__lock = threading.RLock()
+
+    def get(self, key):
+        with self.__lock:
+            return super().get(key)
+
+    def put(self, key, value, size, check=None):
+        with self.__lock:
+            super().put(key, value, size, check)
+
+    def discard(self, key):
+        with self.__lock:
+            super().discard(key)
+
+    def nearest(self, kind, low, high):
+        with self.__lock:
+            return super().nearest(kind, low, high)
+
+
+class _Instruments:
+
+    """
+    Counters and cumulative times of instrumented calls.
+
+    :meth:`call` calls a function and times it under a name; *calls* and
+    *seconds* map the names to the number of calls and the total time
+    spent in them. If *hook* is given, it is called after each timed call
+    with the name and a dict with the 'seconds' of the call, and after
+    each archiving with 'archive' and a dict with the 'version' number,
+    the number of 'changes' and the estimated 'bytes' of the archived
+    difference.
+    """
+
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.calls = {}
+        self.seconds = {}
+
+    def call(self, name, func, *args, **kwargs):
+        """
+        Return ``func(*args, **kwargs)``, timing the call under *name*.
+        """
+        start = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = perf_counter() - start
+            self.calls[name] = self.calls.get(name, 0) + 1
+            self.seconds[name] = self.seconds.get(name, 0.0) + elapsed
+            if self.hook is not None:
+                self.hook(name, {'seconds': elapsed})
+
+    def archived(self, version_n, changes, size):
+        """
+        Report the archiving of version *version_n* to the hook.
+        """
+        if self.hook is not None:
+            self.hook('archive', {'version': version_n, 'changes': changes,
+                                  'bytes': size})
+
+
+class _TimedFunction:
+
+    """
+    A function calling *func*, timed by *instruments* under *name*.
+    """
+
+    def __init__(self, instruments, name, func):
+        self.instruments = instruments
+        self.name = name
+        self.func = func
+
+    def __call__(self, *args, **kwargs):
+        return self.instruments.call(self.name, self.func, *args, **kwargs)
+
+
+def _instrumented(name):
+    """
+    Return a decorator marking a method of :class:`VersionedDict` to be
+    timed under *name*, if the instance is instrumented.
+
+    The method itself is left as it is; instrumented instances get a timed
+    variant installed by :meth:`VersionedDict._VersionedDict__wrap_methods`.
+    """
+    def mark(method):
+        method.instrument_name = name
+        return method
+    return mark
+
+
+def _timed(method, name):
+    """
+    Return *method* of :class:`VersionedDict`, timed under *name*.
+    """
+    @wraps(method)
+    def timed(self, *args, **kwargs):
+        return self._VersionedDict__instruments.call(name, method, self,
+                                                     *args, **kwargs)
+    return timed
+
+
+_READ_ATTEMPTS = 3
+
+
+def _reader(method):
+    """
+    Mark a reading method of :class:`VersionedDict` for *concurrent* use,
+    see :func:`_read_concurrently`.
+    """
+    method.concurrency = _read_concurrently
+    return method
+
+
+def _writer(method):
+    """
+    Mark a method of :class:`VersionedDict` changing archived versions for
+    *concurrent* use, see :func:`_write_concurrently`.
+    """
+    method.concurrency = _write_concurrently
+    return method
+
+
+def _read_concurrently(method):
+    """
+    Return the reading *method* of :class:`VersionedDict` for *concurrent*
+    use.
+
+    The method runs without the lock; if a rewind or compaction was running
+    or started meanwhile, its result is discarded and it runs again, the
+    last time holding the lock.
+    """
+    @wraps(method)
+    def read(self, *args, **kwargs):
+        for _ in range(_READ_ATTEMPTS):
+            epoch = self._VersionedDict__epoch
+            if epoch % 2:
+                break
+            try:
+                result = method(self, *args, **kwargs)
+            except Exception:
+                if self._VersionedDict__epoch == epoch:
+                    raise
+            else:
+                if self._VersionedDict__epoch == epoch:
+                    return result
+        with self._VersionedDict__lock:
+            return method(self, *args, **kwargs)
+    return read
+
+
+def _write_concurrently(method):
+    """
+    Return the *method* of :class:`VersionedDict` changing archived versions
+    for *concurrent* use: it holds the lock, and the epoch is odd meanwhile.
+    """
+    @wraps(method)
+    def write(self, *args, **kwargs):
+        with self._VersionedDict__lock:
+            outer = not self._VersionedDict__epoch % 2
+            if outer:
+                self._VersionedDict__epoch += 1
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                if outer:
+                    self._VersionedDict__epoch += 1
+    return write
+
+
+def _bind_weakly(method, ref):
+    """
+    Return *method* bound to the object referenced by the weak reference
+    *ref*, such that an object can hold its own bound methods without a
+    reference cycle.
+    """
+    @wraps(method)
+    def bound(*args, **kwargs):
+        return method(ref(), *args, **kwargs)
+    return bound
 
 
 class VersionedDictInvalidVersionError(Exception):
@@ -66,55 +1027,435 @@ class VersionedDictInvalidVersionError(Exception):
     Error associated with VersionedDict: invalid version requested.
 
     Occurs when :meth:`VersionedDict.get_version` was called with an
-    unavailable version number.
+    unavailable version number. If the version has existed, but has been
+    removed by a compaction (see :meth:`VersionedDict.squash`), then
+    :attr:`compacted` is True.
     """
 
     def __init__(self, versioned_dict, req_ver_n):
         self.versioned_dict = versioned_dict
         self.req_ver_n = req_ver_n
+        self.max_ver_n = versioned_dict.version_number
+        self.compacted = versioned_dict._version_compacted(req_ver_n)
 
     def __str__(self):
-        max_ver_n = self.versioned_dict.version_number()
-        if max_ver_n:
+        if self.compacted:
+            return 'VersionedDict version %i has been compacted away' % \
+                self.req_ver_n
+        if self.max_ver_n:
             return 'VersionedDict instance has versions up to %i, '\
-                   'but no version %i' % (max_ver_n, self.req_ver_n)
+                   'but no version %r' % (self.max_ver_n, self.req_ver_n)
         else:
             return 'VersionedDict instance has no versions'
 
 
-class VersionedDictRewindError(Exception):
+class VersionedDictRewindError(Exception):
+
+    """
+    Error associated with VersionedDict: rewind impossible.
+
+    Occurs when version_number equals 0 and thus no previous version
+    has been archived.
+    """
+
+    def __str__(self):
+        return 'VersionedDict rewind impossible'
+
+
+class VersionedDictStaleViewError(Exception):
+
+    """
+    Error associated with VersionedDictView: version no longer available.
+
+    Occurs when a view is used after the version it belongs to has been
+    rewound or compacted away, or, for a view of the current version,
+    after it has been archived.
+    """
+
+    def __init__(self, version_n):
+        self.version_n = version_n
+
+    def __str__(self):
+        return 'VersionedDict version %i of this view has been archived, '\
+               'rewound or compacted' % self.version_n
+
+
+class VersionedDictView(Mapping):
+
+    """
+    A read-only view of a version of a :class:`VersionedDict`.
+
+    Items are looked up in the archive on demand. The set of keys of an
+    archived version is reconstructed on first use of :func:`len` or
+    iteration. A view of the current version shows its changes until
+    :meth:`VersionedDict.forward_version` archives it. If the version is
+    archived, rewound or compacted away, further use raises
+    :class:`VersionedDictStaleViewError`.
+
+    Note: Values are not (deep) copies.
+    """
+
+    def __init__(self, versioned_dict, version_n):
+        self.__versioned_dict = versioned_dict
+        self.__version_n = version_n
+        self.__token = versioned_dict._version_token(version_n)
+        self.__current = version_n == versioned_dict.version_number
+        self.__keys = None
+
+    @property
+    def version_number(self):
+        """
+        Return the number of the version of this view.
+        """
+        return self.__version_n
+
+    def __check(self):
+        if self.__versioned_dict._version_token(self.__version_n) \
+                is not self.__token:
+            raise VersionedDictStaleViewError(self.__version_n)
+
+    def __getitem__(self, key):
+        self.__check()
+        return self.__versioned_dict.lookup_value(key,
+                                                  version_n=self.__version_n)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __archived_keys(self):
+        self.__check()
+        if self.__current:
+            return self.__versioned_dict.keys_in_version(
+                version_n=self.__version_n)
+        if self.__keys is None:
+            self.__keys = self.__versioned_dict.keys_in_version(
+                version_n=self.__version_n)
+        return self.__keys
+
+    def __iter__(self):
+        return iter(self.__archived_keys())
+
+    def __len__(self):
+        return len(self.__archived_keys())
+
+    def __repr__(self):
+        return '<%s of version %i>' % (type(self).__name__, self.__version_n)
+
+
+class RetentionPolicy:
+
+    """
+    A policy for the automatic compaction of the archive of a
+    :class:`VersionedDict`, applied on each archiving.
+
+    The latest *keep_last* archived versions are always kept. Of the
+    older versions, only those whose version number is a multiple of
+    *keep_every* are kept, or none, if *keep_every* is None. If
+    *max_bytes* is given, the oldest versions are folded into the base
+    snapshot while the estimated size of the archive (the size of the
+    log file, if any) exceeds it.
+    """
+
+    def __init__(self, keep_last=None, keep_every=None, max_bytes=None):
+        for name, value in (('keep_last', keep_last),
+                            ('keep_every', keep_every),
+                            ('max_bytes', max_bytes)):
+            if value is not None and (not isinstance(value, int) or
+                                      value < 1):
+                raise ValueError('%s must be a positive int' % name)
+        if keep_every is not None and keep_last is None:
+            keep_last = 1
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.max_bytes = max_bytes
+
+    def __repr__(self):
+        return '%s(keep_last=%r, keep_every=%r, max_bytes=%r)' % (
+            type(self).__name__, self.keep_last, self.keep_every,
+            self.max_bytes)
+
+
+class VersionedDict(dict):
+
+    """
+    A versioned dictionary derived from :class:`dict`.
+
+    Instances of this class behave like a conventional :class:`dict` object.
+    Reading the current version costs the same as for a :class:`dict`;
+    writing it additionally records the touched keys. The archive remains
+    unaffected. The current value is affected only by
+    :meth:`rewind_version`. Calling
+    :meth:`forward_version` does not affect the current version; it just
+    archives a copy of it and increments the :attr:`version_number`.
+    Initially the :attr:`version_number` equals 0.
+
+    The keys touched by the mutating methods of the dict are remembered
+    until the next :meth:`forward_version`, which then diffs only these.
+    If values are mutated in place, pass *full_diff=True*; then all keys
+    are diffed against the latest archived version.
+
+    *copy_strategy* determines how keys and values are copied into the
+    archive and back: 'deep' (default) uses :func:`copy.deepcopy`,
+    'shallow' uses :func:`copy.copy`, 'none' stores references (only
+    suitable for values which are never mutated) and 'pickle' makes a
+    pickle round trip; alternatively a callable returning a copy of its
+    argument may be given. Immutable objects like str, int, bytes and
+    tuples thereof are never copied.
+
+    If *nested_deltas* is True, a modified value of type dict, list or set
+    whose estimated size reaches *nested_threshold* bytes is archived as
+    a path-based difference against its previous value instead of
+    a complete copy.
+
+    If *intern_values* is True, archived values are kept in a pool where
+    values with equal content are stored only once. Values are identified
+    by the key returned by *hasher* (by default a digest of their pickle);
+    if it returns None, the value is not pooled.
+
+    If *fingerprints* is True, a modified value is detected by comparing
+    the key returned by *hasher* for the current value with the one of the
+    archived value, which is cached per key. Only if the keys differ (or
+    cannot be computed) are the values compared with ``!=``. A value which
+    is the archived object itself is never compared. The default *hasher*
+    pickles the values, which costs more than comparing them in most cases;
+    fingerprints pay off with a *hasher* that is cheap for large values
+    (e.g., returning a revision number stored in the value).
+
+    An instance created with :meth:`create` stores the archive in an
+    append-only log file instead of in memory. Archived differences are
+    read back from the file only when needed. Use :meth:`open` to attach
+    to an existing log file. A log file cannot be combined with
+    *intern_values*. A copy or pickle of such an instance refers to the
+    same log file, so only one of them may archive or rewind versions.
+
+    If *checkpoint_interval* is a positive int N, then every N-th archived
+    version is additionally stored as a full snapshot (sharing the values
+    with the archive). Reconstructing a version then starts from the
+    nearest snapshot instead of the oldest version. See :meth:`archive_stats`.
+
+    If *compression* is one of 'zlib', 'lzma' and 'bz2', then archived
+    differences older than the newest *compression_window* versions are
+    pickled and compressed with this module. They are decompressed on
+    demand; the latest few decompressed ones are cached. Values which
+    cannot be pickled prevent the compression of their difference.
+    *compression* cannot be combined with a log file or *intern_values*.
+
+    If *cache_size* (a number of entries) or *cache_bytes* (an estimated
+    size) is given, then reconstructed versions and key sets of archived
+    versions are kept in a cache of this size, evicting the least recently
+    used entries. The cache returns copies; an entry is dropped when its
+    version is rewound or compacted away.
+
+    The archive can be compacted with :meth:`squash` and
+    :meth:`prune_before`, or automatically by a :class:`RetentionPolicy`
+    given as *retention*. Version numbers are never reused by compaction:
+    the remaining versions keep their numbers and the removed ones become
+    invalid, so the archived version numbers may have gaps.
+
+    :meth:`fork` returns a new instance sharing the archived versions with
+    this one; see :meth:`branches`, :meth:`common_ancestor` and
+    :meth:`diff_branch`.
+
+    If *instrument* is True or an *instrument_hook* is given, the public
+    methods (except the generators) and the internal phases of key set
+    reconstruction ('reconstruct_keys'), version reconstruction
+    ('reconstruct'), value lookup ('lookup'), copying ('copy') and value
+    comparison ('compare') are counted and timed, and the estimated size
+    of each archived difference is tracked; see :meth:`archive_stats`.
+    Calls made internally are counted as well. *instrument_hook* is called
+    with the name and a dict of details after each timed call and after each
+    archiving (name 'archive'), e.g., to forward them to a metrics system.
+    Without instrumentation, no timing takes place.
+
+    If *concurrent* is True, one thread may keep changing this dict and
+    archiving versions while other threads read archived versions with
+    :meth:`lookup_value`, :meth:`lookup_values`, :meth:`lookup_version`,
+    :meth:`keys_in_version`, :meth:`view`, :meth:`diff_previous` and
+    :meth:`diff_pair`. Archived versions are never changed in place once
+    published, and archiving only appends to the archive, so the readers
+    do not wait for it. :meth:`rewind_version` and the compactions hold
+    a lock and mark the archive as changing; a read overlapping one of them
+    is repeated, after a few attempts under the lock. Reads of the current
+    version are not synchronized with the writing thread. All other
+    methods, also those of forks, must be called by the writing thread.
+    *concurrent* cannot be combined with a log file, *compression* or
+    *nested_deltas*.
+
+    Note: The keyword arguments documented above are consumed by the
+    constructor and cannot be used as keys of the initial items.
+    """
+
+    def __init__(self, *args, full_diff=False, copy_strategy='deep',
+                 nested_deltas=False, nested_threshold=4096,
+                 intern_values=False, hasher=_default_digest,
+                 fingerprints=False, checkpoint_interval=None, retention=None,
+                 cache_size=None, cache_bytes=None, compression=None,
+                 compression_window=16, instrument=False,
+                 instrument_hook=None, concurrent=False, **kwargs):
+        for name, value in (('checkpoint_interval', checkpoint_interval),
+                            ('cache_size', cache_size),
+                            ('cache_bytes', cache_bytes)):
+            if value is not None and (not isinstance(value, int) or
+                                      value < 1):
+                raise ValueError('%s must be a positive int' % name)
+        if not callable(hasher):
+            raise ValueError('hasher must be callable')
+        if retention is not None and not isinstance(retention,
+                                                    RetentionPolicy):
+            raise ValueError('retention must be a RetentionPolicy')
+        if compression is not None:
+            if compression not in _CODECS:
+                raise ValueError('compression must be one of %s'
+                                 % ', '.join(map(repr, _CODECS)))
+            if intern_values:
+                raise ValueError('compression cannot be used with '
+                                 'intern_values')
+            if not isinstance(compression_window, int) or \
+                    compression_window < 0:
+                raise ValueError('compression_window must be a '
+                                 'non-negative int')
+        if instrument_hook is not None and not callable(instrument_hook):
+            raise ValueError('instrument_hook must be callable')
+        if concurrent and (compression is not None or nested_deltas):
+            raise ValueError('concurrent cannot be used with compression '
+                             'or nested_deltas')
+        self.__compression = compression
+        self.__compression_window = compression_window
+        self.__deltas = _DeltaList()  # history: one _Delta per version
+        self.__stored = []         # version numbers of the deltas
+        self.__tokens = []         # per delta: identity of the archiving
+        self.__history = {}        # per key: versions in which it changed
+        self.__checkpoints = {}    # full snapshots of some versions
+        self.__checkpoint_interval = checkpoint_interval
+        self.__cache = None        # reconstructed versions and key sets
+        if cache_size is not None or cache_bytes is not None:
+            cache_type = _SharedLRUCache if concurrent else _LRUCache
+            self.__cache = cache_type(cache_size, cache_bytes)
+        self.__retention = retention
+        self.__delta_sizes = None  # per delta: estimated size in memory
+        if retention is not None and retention.max_bytes is not None:
+            self.__delta_sizes = []
+        self.__version = 0
+        self.__full_diff = full_diff
+        self.__copy = _copy_function(copy_strategy)
+        self.__nested_threshold = nested_threshold if nested_deltas else None
+        self.__patched = {}        # resolved latest values of patched keys
+        self.__pool = {} if intern_values else None
+        self.__pool_digests = {}   # id of pooled value -> its pool key
+        self.__pool_stats = {'hits': 0, 'misses': 0, 'bytes_saved': 0}
+        self.__hasher = hasher
+        self.__touched = set()     # keys touched since the latest archiving
+        self.__parent = None       # the forked instance sharing its archive
+        self.__fork_n = None       # the latest version shared with it
+        self.__branches = []       # weak references to the forks
+        self.__fingerprints = {} if fingerprints else None
+        self.__instruments = None  # counters and times of calls
+        if instrument or instrument_hook is not None:
+            self.__instrument(_Instruments(instrument_hook))
+        self.__lock = threading.RLock() if concurrent else None
+        self.__epoch = 0           # odd during rewinds and compactions
+        self.__current_token = object()  # identity of the current version
+        self.__wrap_methods()
+        super().__init__(*args, **kwargs)
+
+    def __instrument(self, instruments):
+        """
+        Time the calls of this instance with *instruments*, before anything
+        is archived.
+
+        The timed public methods are installed by :meth:`__wrap_methods`,
+        the internal phases are timed through :meth:`__timed`; only the copy
+        function is replaced by a timed one.
+        """
+        self.__instruments = instruments
+        self.__copy = _TimedFunction(instruments, 'copy', self.__copy)
+        if self.__delta_sizes is None and \
+                not isinstance(self.__deltas, _DeltaLog):
+            self.__delta_sizes = []
+
+    def __wrap_methods(self):
+        """
+        Install the timed and concurrent variants of the marked methods as
+        attributes of this instance, as far as it is instrumented or
+        *concurrent*.
+
+        Otherwise calls reach the methods of the class directly.
+        """
+        if self.__instruments is None and self.__lock is None:
+            return
+        ref = weakref.ref(self)
+        for name, instrument_name, concurrency in _MARKED_METHODS:
+            method = original = getattr(type(self), name)
+            if concurrency is not None and self.__lock is not None:
+                method = concurrency(method)
+            if instrument_name is not None and \
+                    self.__instruments is not None:
+                method = _timed(method, instrument_name)
+            if method is not original:
+                self.__dict__[name] = _bind_weakly(method, ref)
+
+    def __setitem__(self, key, value):
+        self.__touched.add(key)
+        super().__setitem__(key, value)
 
-    """
-    Error associated with VersionedDict: rewind impossible.
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.__touched.add(key)
 
-    Occurs when version_number equals 0 and thus no previous version
-    has been archived.
-    """
+    def __ior__(self, other):
+        self.update(other)
+        return self
 
-    def __str__(self):
-        return 'VersionedDict rewind impossible'
+    def update(self, *args, **kwargs):
+        items = dict(*args, **kwargs)
+        self.__touched.update(items)
+        super().update(items)
 
+    def pop(self, key, *args):
+        if key in self:
+            self.__touched.add(key)
+        return super().pop(key, *args)
 
-class VersionedDict(dict):
+    def popitem(self):
+        key, value = super().popitem()
+        self.__touched.add(key)
+        return key, value
 
-    """
-    A versioned dictionary derived from :class:`dict`.
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self.__touched.add(key)
+        return super().setdefault(key, default)
 
-    Instances of this class behave like a conventional :class:`dict` object.
-    In such usage the current version is used without overhead; the archive
-    remains unaffected. The current value is affected only by
-    :meth:`rewind_version`. Calling :meth:`forward_version` does not affect
-    the current version; it just archives a deep copy of it and increments
-    the :attr:`version_number`. Initially the :attr:`version_number` equals 0.
-    """
+    def clear(self):
+        self.__touched.update(self.keys())
+        super().clear()
 
-    def __init__(self, *args, **kwargs):
-        self.__additions = []      # history for added keys
-        self.__deletions = []      # history for deleted keys
-        self.__modifications = []  # history for changed values
-        self.__version = 0
-        super().__init__(*args, **kwargs)
+    def __reduce__(self):
+        attributes = dict(self.__dict__)
+        for name, _, _ in _MARKED_METHODS:
+            attributes.pop(name, None)
+        attributes['_VersionedDict__branches'] = []
+        if self.__lock is not None:
+            attributes['_VersionedDict__lock'] = True
+            attributes['_VersionedDict__epoch'] = 0
+        return copyreg.__newobj__, (type(self),), (dict(self), attributes)
 
+    def __setstate__(self, state):
+        items, attributes = state
+        self.__dict__.update(attributes)
+        if self.__lock is not None:
+            self.__lock = threading.RLock()
+        if self.__pool is not None:
+            self.__pool_digests = {id(entry[0]): digest
+                                   for digest, entry in self.__pool.items()}
+        self.__wrap_methods()
+        super().update(items)
+
+    @_instrumented('forward_version')
     def forward_version(self):
         """
         Create a new version and return its number.
@@ -123,76 +1464,372 @@ class VersionedDict(dict):
         and put the difference on the archive stack, while retaining the
         current value.
         """
-        if self.version_number > 0:
-            addition, deletion, modification = \
+        copy_obj = self.__copy
+        archive_value = self.__archive_value
+        if self.__latest_archived() is not None:
+            addition, deletion, modification, replaced = \
                 self.__diff_current_against_latest_archived()
-            # archive addition
-            self.__additions.append(addition)
-            # archive deletion
-            self.__deletions.append(deletion)
-            # archive modification
-            self.__modifications.append(modification)
+            delta = _Delta(
+                {copy_obj(key): archive_value(value)
+                 for key, value in addition.items()},
+                {copy_obj(key): value for key, value in deletion.items()},
+                {}, {})
+            for key, value in modification.items():
+                old_value = replaced[key]
+                key_copy = copy_obj(key)
+                patch = self.__nested_patch(old_value, value)
+                if patch is None:
+                    delta.modification[key_copy] = archive_value(value)
+                    delta.replaced[key_copy] = old_value
+                else:
+                    delta.modification[key_copy] = patch
+                    self.__patched[key_copy] = patch.apply(old_value)
         else:
-            self.__additions.append({deepcopy(key): deepcopy(value)
-                                     for key, value in self.items()})
-            self.__deletions.append({})
-            self.__modifications.append({})
+            delta = _Delta({copy_obj(key): archive_value(value)
+                            for key, value in self.items()}, {}, {}, {})
+        for key in delta.replaced.keys() | delta.deletion.keys():
+            self.__patched.pop(key, None)
+        if self.__fingerprints is not None:
+            for key in delta.deletion:
+                self.__fingerprints.pop(key, None)
+        version_n = self.__version
+        self.__deltas.append(delta, version_n)
+        self.__stored.append(version_n)
+        self.__tokens.append(object())
+        if self.__delta_sizes is not None:
+            self.__delta_sizes.append(_delta_sizeof(delta))
+        if self.__instruments is not None:
+            self.__instruments.archived(
+                version_n, len(self.__delta_keys(delta)),
+                self.__delta_size(len(self.__stored) - 1))
+        self.__index_latest_archived()
+        if self.__compression is not None:
+            self.__pack(len(self.__stored) - 1 - self.__compression_window)
+        if self.__checkpoint_interval and version_n and \
+                version_n % self.__checkpoint_interval == 0:
+            self.__checkpoints[version_n] = self.__timed(
+                'reconstruct', self.__reconstruct)(version_n)
+        if self.__full_diff and self.__cache is not None:
+            keys = frozenset(self)
+            self.__cache.put(('keys', version_n), keys, sys.getsizeof(keys))
+        self.__touched = set()
         self.__version += 1
+        self.__current_token = object()
+        if self.__retention is not None:
+            self.__apply_retention()
         return self.__version
 
+    def __archive_value(self, value):
+        """
+        Return a copy of *value* for the archive.
+
+        If *intern_values* is set, return the pooled value with equal
+        content, if there is one; otherwise pool the copy.
+        """
+        if self.__pool is None:
+            return self.__copy(value)
+        digest = self.__hasher(value)
+        if digest is None:
+            return self.__copy(value)
+        entry = self.__pool.get(digest)
+        if entry is None:
+            value = self.__copy(value)
+            entry = self.__pool[digest] = [value, 0, _deep_sizeof(value)]
+            self.__pool_digests[id(value)] = digest
+            self.__pool_stats['misses'] += 1
+        else:
+            self.__pool_stats['hits'] += 1
+            self.__pool_stats['bytes_saved'] += entry[2]
+        entry[1] += 1
+        return entry[0]
+
+    def __pack(self, pos):
+        """
+        Compress the archived difference at index *pos*, if it is cold,
+        i.e., older than the newest *compression_window* versions.
+        """
+        if 0 <= pos < len(self.__stored) - self.__compression_window:
+            self.__deltas.pack(pos, self.__compression)
+            if self.__delta_sizes is not None:
+                self.__delta_sizes[pos] = _delta_sizeof(
+                    self.__deltas.records(pos, pos + 1)[0])
+
+    def __retain_value(self, value):
+        """
+        Count another reference to an archived *value* (if it is pooled).
+        """
+        digest = self.__pool_digests.get(id(value))
+        if digest is not None and self.__pool[digest][0] is value:
+            self.__pool[digest][1] += 1
+
+    def __release_value(self, value):
+        """
+        Release an archived *value* from the pool (if it is pooled).
+        """
+        digest = self.__pool_digests.get(id(value))
+        if digest is not None and self.__pool[digest][0] is value:
+            entry = self.__pool[digest]
+            entry[1] -= 1
+            if not entry[1]:
+                del self.__pool[digest]
+                del self.__pool_digests[id(value)]
+
+    def __nested_patch(self, old_value, value):
+        """
+        Return a :class:`_Patch` from *old_value* to *value*, if worthwhile.
+
+        Return None, if *nested_deltas* is off, the values are not nested
+        values of the same type or *value* is below *nested_threshold*.
+        """
+        threshold = self.__nested_threshold
+        if threshold is None or type(value) is not type(old_value) or \
+                type(value) not in _NESTED_TYPES or \
+                _deep_sizeof(value, limit=threshold) < threshold:
+            return None
+        patch = _Patch.diff(old_value, value, self.__copy)
+        return patch if patch.ops else None
+
+    def __index_latest_archived(self):
+        """
+        Add the keys of the latest archived version to the history index.
+        """
+        version_n = self.__stored[-1]
+        for keys in self.__deltas.keys(-1):
+            for key in keys:
+                self.__history.setdefault(key, []).append(version_n)
+
+    def __unindex_latest_archived(self):
+        """
+        Remove the keys of the latest archived version from the history index.
+        """
+        version_n = self.__stored[-1]
+        for key in self.__delta_keys(self.__deltas[-1]):
+            versions = self.__history[key]
+            if versions[-1] == version_n:
+                versions.pop()
+            if not versions:
+                del self.__history[key]
+
+    @staticmethod
+    def __delta_keys(delta):
+        """
+        Return a set of the keys added, deleted or modified in *delta*.
+        """
+        return delta.addition.keys() | delta.deletion.keys() | \
+            delta.modification.keys()
+
     def __diff_current_against_latest_archived(self):
         """
-        Diff the current version agaionst the latest archived one.
+        Diff the current version against the latest archived one.
 
-        Return 3 dictionaries: addition (with added key-value pairs),
+        Return 4 dictionaries: addition (with added key-value pairs),
         deletion (with deleted keys and their latest values),
-        modification (with keys which had a values change and the new value).
+        modification (with keys which had a values change and the new value),
+        replaced (with the modified keys and their latest values).
+        The dictionaries are not (deep) copies.
+
+        Only the touched keys are examined, unless *full_diff* is set,
+        in which case all keys of both versions are examined.
         """
-        archived_keys = self.keys_in_version(version_n=self.version_number - 1)
-        addition = {deepcopy(key): deepcopy(value)
-                    for key, value in self.items()
-                    if key not in archived_keys}
+        version_n = self.__latest_archived()
+        if self.__full_diff:
+            keys = self.__timed('reconstruct_keys', self.__reconstruct_keys)(
+                version_n) | self.keys()
+        else:
+            keys = self.__touched
+        addition = {}
         deletion = {}
-        for key in archived_keys - set(self.keys()):
-            value = self.lookup_value(
-                key,
-                version_n=self.version_number - 1
-            )
-            deletion[deepcopy(key)] = deepcopy(value)
         modification = {}
-        for key in archived_keys.intersection(set(self.keys())):
-            value = self.lookup_value(
-                key,
-                version_n=self.version_number - 1
-            )
-            if self[key] != value:
-                modification[deepcopy(key)] = deepcopy(self[key])
-        return addition, deletion, modification
+        replaced = {}
+        lookup = self.__timed('lookup', self.__lookup)
+        differs = self.__timed('compare', self.__differs)
+        for key in keys:
+            try:
+                value = lookup(key, version_n)
+            except KeyError:
+                if key in self:
+                    addition[key] = self[key]
+                continue
+            if key not in self:
+                deletion[key] = value
+            elif self[key] is not value and \
+                    differs(key, self[key], value):
+                modification[key] = self[key]
+                replaced[key] = value
+        return addition, deletion, modification, replaced
 
+    def __changed(self, key, archived):
+        """
+        Return whether the current value of *key* differs from its
+        *archived* value in the latest archived version.
+        """
+        value = self[key]
+        if value is archived:
+            return False
+        return self.__timed('compare', self.__differs)(key, value, archived)
+
+    def __timed(self, name, func):
+        """
+        Return *func*, timed under *name* if this instance is instrumented.
+
+        Called once per operation, such that the internal phases do not
+        check for instrumentation per key.
+        """
+        if self.__instruments is None:
+            return func
+        return _TimedFunction(self.__instruments, name, func)
+
+    def __differs(self, key, value, archived):
+        """
+        Return whether *value* differs from the *archived* value of *key*.
+
+        With *fingerprints*, compare their fingerprints first and cache the
+        one of *archived*.
+        """
+        fingerprints = self.__fingerprints
+        if fingerprints is not None:
+            entry = fingerprints.get(key)
+            if entry is None or entry[0] is not archived:
+                entry = fingerprints[key] = (archived,
+                                             self.__hasher(archived))
+            if entry[1] is not None and self.__hasher(value) == entry[1]:
+                return False
+        return value != archived
+
+    @_instrumented('rewind_version')
+    @_writer
     def rewind_version(self):
         """
         Restore the previous version and return its number.
 
-        Recreate the latest older version by consecutively updating an empty
-        dict with the stored versions. Dispose the current version.
-        """
-        if self.version_number > 0:
-            archived_keys = self.keys_in_version(
-                                            version_n=self.version_number - 1)
-            archived_dict = {}
-            for key in archived_keys:
-                val = self.lookup_value(key, version_n=self.version_number - 1)
-                archived_dict[key] = val
-            self.clear()
-            self.update(deepcopy(archived_dict))
-            del self.__additions[-1]
-            del self.__deletions[-1]
-            del self.__modifications[-1]
-            self.__version -= 1
+        Revert the changes of the current version against the latest
+        archived one; only the affected keys are reset. Then remove the
+        latest archived version from the archive; its difference becomes
+        the change of the current version. The current version takes the
+        number of the restored version.
+        """
+        if not self.__stored:
+            self.__detach()
+        if self.__stored:
+            self.__detach_branches(self.__stored[-1])
+            addition, deletion, modification, replaced = \
+                self.__diff_current_against_latest_archived()
+            for key in addition:
+                super().__delitem__(key)
+            for key, value in deletion.items():
+                super().__setitem__(key, self.__copy(value))
+            for key, value in replaced.items():
+                super().__setitem__(key, self.__copy(value))
+            delta = self.__deltas[-1]
+            self.__touched = self.__delta_keys(delta)
+            for key in self.__touched:
+                self.__patched.pop(key, None)
+                if self.__fingerprints is not None:
+                    self.__fingerprints.pop(key, None)
+            if self.__pool is not None:
+                for value in delta.addition.values():
+                    self.__release_value(value)
+                for value in delta.modification.values():
+                    self.__release_value(value)
+            self.__unindex_latest_archived()
+            self.__checkpoints.pop(self.__stored[-1], None)
+            self.__uncache(self.__stored[-1])
+            del self.__deltas[-1]
+            del self.__tokens[-1]
+            if self.__delta_sizes is not None:
+                del self.__delta_sizes[-1]
+            self.__version = self.__stored.pop()
+            self.__current_token = object()
+            if not self.__stored:
+                self.__history.clear()
             return self.__version
         else:
             raise VersionedDictRewindError()
 
+    @classmethod
+    def create(cls, path, *args, **kwargs):
+        """
+        Return a new instance storing its archive in a new log file at
+        *path*.
+
+        *args* and *kwargs* are the initial items and the options of the
+        constructor. If the file exists, raise :class:`FileExistsError`.
+        """
+        versioned_dict = cls(*args, **kwargs)
+        versioned_dict.__check_log()
+        versioned_dict.__attach(_DeltaLog.create(path))
+        return versioned_dict
+
+    @classmethod
+    def open(cls, path, **kwargs):
+        """
+        Return a new instance attached to the existing log file at *path*.
+
+        *kwargs* are the options of the constructor.
+        The archived differences are not loaded; only the keys of the
+        archived versions are read to build the index, and the records in
+        which the current values were set. The current version is the
+        latest archived version, with the next version number.
+        The *retention* policy is applied on the next archiving. Checkpoints
+        (see *checkpoint_interval*) are made only for versions archived
+        after opening.
+        """
+        versioned_dict = cls(**kwargs)
+        if versioned_dict:
+            raise TypeError('unexpected keyword arguments: %s'
+                            % ', '.join(versioned_dict))
+        versioned_dict.__check_log()
+        versioned_dict.__attach(_DeltaLog.open(path))
+        return versioned_dict
+
+    def __check_log(self):
+        """
+        Raise :class:`ValueError`, if the options of this instance do not
+        allow a log file.
+        """
+        if self.__pool is not None or self.__compression is not None or \
+                self.__lock is not None:
+            raise ValueError('a log file cannot be used with intern_values, '
+                             'compression or concurrent')
+
+    def __attach(self, deltas):
+        """
+        Use *deltas* as the archive and restore its latest version.
+
+        Only the records in which the live keys were last set are read,
+        each once.
+        """
+        self.__deltas = deltas
+        self.__delta_sizes = None
+        self.__tokens = [object() for _ in range(len(deltas))]
+        latest = {}   # live key -> position of the record last setting it
+        for pos, (version_n, added, deleted, modified) in \
+                enumerate(deltas.scan()):
+            self.__stored.append(version_n)
+            for key in deleted:
+                latest.pop(key, None)
+            for keys in (added, modified):
+                for key in keys:
+                    latest[key] = pos
+            for keys in (added, deleted, modified):
+                for key in keys:
+                    self.__history.setdefault(key, []).append(version_n)
+        if not self.__stored:
+            return
+        self.__version = self.__stored[-1] + 1
+        keys_by_pos = {}
+        for key, pos in latest.items():
+            keys_by_pos.setdefault(pos, []).append(key)
+        for pos in sorted(keys_by_pos):
+            delta = deltas[pos]
+            for key in keys_by_pos[pos]:
+                value = delta.addition.get(key, MISSING)
+                if value is MISSING:
+                    value = delta.modification[key]
+                if type(value) is _Patch:
+                    value = self.__lookup(key, self.__stored[pos])
+                super().__setitem__(key, self.__copy(value))
+
     @property
     def version_number(self):
         """
@@ -208,11 +1845,59 @@ class VersionedDict(dict):
         Return whether *version_n* is a valid version number.
 
         *version_n* must be a non-negative int not bigger than
-        self.version_number .
+        self.version_number and it must not have been compacted away.
+        """
+        if not isinstance(version_n, int):
+            return False
+        if self.__parent is not None and 0 <= version_n <= self.__fork_n:
+            return self.__parent.version_number_valid(version_n)
+        return (version_n == self.__version or
+                0 <= version_n < self.__version and
+                self.__position(version_n) is not None)
+
+    def _version_compacted(self, version_n):
+        """
+        Return whether *version_n* has been removed by a compaction.
+        """
+        return (isinstance(version_n, int) and
+                0 <= version_n < self.__version and
+                not self.version_number_valid(version_n))
+
+    def __latest_archived(self):
+        """
+        Return the number of the latest archived version.
+
+        If there is none, return None.
+        """
+        if self.__stored:
+            return self.__stored[-1]
+        return self.__fork_n
+
+    def __position(self, version_n):
+        """
+        Return the index of archived version *version_n* in the archive.
+
+        If the version is not archived, return None.
+        """
+        stored = self.__stored
+        if stored:
+            pos = version_n - stored[0]
+            if not (0 <= pos < len(stored) and stored[pos] == version_n):
+                pos = bisect_left(stored, version_n)
+            if pos < len(stored) and stored[pos] == version_n:
+                return pos
+        return None
+
+    def __positions(self, version_n1, version_n2):
+        """
+        Return the range of indexes of the archived versions after
+        *version_n1* up to *version_n2* (inclusive).
         """
-        return (isinstance(version_n, int) and version_n >= 0 and
-                version_n <= self.version_number)
+        return range(bisect_right(self.__stored, version_n1),
+                     bisect_right(self.__stored, version_n2))
 
+    @_instrumented('lookup_version')
+    @_reader
     def lookup_version(self, version_n):
         """
         Return the archived version for a given version number *version_n*.
@@ -226,13 +1911,117 @@ class VersionedDict(dict):
             raise VersionedDictInvalidVersionError(self, version_n)
         if version_n == self.version_number:
             return self
-        archived_keys = self.keys_in_version(version_n=version_n)
-        archived_dict = {}
-        for key in archived_keys:
-            val = self.lookup_value(key, version_n=version_n)
-            archived_dict[key] = val
+        return self.__timed('reconstruct', self.__reconstruct)(version_n)
+
+    def __nearest_checkpoint(self, version_n):
+        """
+        Return the number of the nearest checkpoint not after *version_n*.
+
+        If there is none after the oldest archived version, return None.
+        """
+        if self.__checkpoint_interval:
+            checkpoint_n = version_n - version_n % self.__checkpoint_interval
+            while checkpoint_n > self.__stored[0]:
+                if checkpoint_n in self.__checkpoints:
+                    return checkpoint_n
+                checkpoint_n -= self.__checkpoint_interval
+        return None
+
+    def __reconstruct(self, version_n):
+        """
+        Return a new dict with the archived version *version_n*.
+
+        Start from the nearest checkpoint (or from the oldest archived
+        version) and apply the following archived differences.
+        """
+        if self.__parent is not None and version_n <= self.__fork_n:
+            return self.__parent.__reconstruct(version_n)
+        cache = self.__cache
+        epoch = self.__epoch
+        if cache is not None:
+            cached = cache.get(('version', version_n))
+            if cached is not None:
+                return dict(cached)
+        checkpoint_n = self.__nearest_checkpoint(version_n)
+        if checkpoint_n is None and self.__parent is not None:
+            start_n = self.__fork_n
+        elif checkpoint_n is None:
+            start_n = self.__stored[0]
+        else:
+            start_n = checkpoint_n
+        nearest = None if cache is None else \
+            cache.nearest('version', start_n, version_n)
+        cached = None if nearest is None else cache.get(nearest)
+        if cached is not None:
+            archived_dict = dict(cached)
+            checkpoint_n = nearest[1]
+        elif checkpoint_n is None and self.__parent is not None:
+            archived_dict = self.__parent.__reconstruct(self.__fork_n)
+            checkpoint_n = self.__fork_n
+        elif checkpoint_n is None:
+            archived_dict = dict(self.__deltas[0].addition)
+            checkpoint_n = self.__stored[0]
+        else:
+            archived_dict = dict(self.__checkpoints[checkpoint_n])
+        positions = self.__positions(checkpoint_n, version_n)
+        for delta in self.__deltas[positions.start:positions.stop]:
+            for key in delta.deletion:
+                del archived_dict[key]
+            archived_dict.update(delta.addition)
+            for key, value in delta.modification.items():
+                if type(value) is _Patch:
+                    value = value.apply(archived_dict[key])
+                archived_dict[key] = value
+        if cache is not None:
+            cache.put(('version', version_n), dict(archived_dict),
+                      sys.getsizeof(archived_dict),
+                      lambda: self.__epoch == epoch)
         return archived_dict
 
+    def __uncache(self, version_n):
+        """
+        Drop the cached reconstruction and key set of *version_n*.
+        """
+        if self.__cache is not None:
+            self.__cache.discard(('version', version_n))
+            self.__cache.discard(('keys', version_n))
+
+    @_reader
+    def view(self, version_n):
+        """
+        Return a read-only mapping of the version with number *version_n*.
+
+        Return a :class:`VersionedDictView`, which resolves items on
+        demand. A view of the current version becomes stale once it is
+        archived or rewound.
+
+        If the version is invalid, raise
+        :class:`VersionedDictInvalidVersionError`.
+        """
+        if not self.version_number_valid(version_n):
+            raise VersionedDictInvalidVersionError(self, version_n)
+        return VersionedDictView(self, version_n)
+
+    @_reader
+    def _version_token(self, version_n):
+        """
+        Return an object identifying the version *version_n*.
+
+        The object changes when the version is archived, or rewound and
+        recreated. If the version is neither archived nor current, return
+        None.
+        """
+        if version_n == self.__version:
+            return self.__current_token
+        if self.__parent is not None and version_n <= self.__fork_n:
+            return self.__parent._version_token(version_n)
+        pos = self.__position(version_n)
+        if pos is None:
+            return None
+        return self.__tokens[pos]
+
+    @_instrumented('keys_in_version')
+    @_reader
     def keys_in_version(self, version_n=None):
         """
         Return a set of keys in the version with number *version_n*.
@@ -245,12 +2034,44 @@ class VersionedDict(dict):
             raise VersionedDictInvalidVersionError(self, version_n)
         if version_n is None or version_n == self.version_number:
             return self.keys()
-        archived_keys = set()
-        for version_i in range(version_n + 1):
-            archived_keys |= set(self.__additions[version_i].keys())
-            archived_keys -= set(self.__deletions[version_i].keys())
+        return self.__timed('reconstruct_keys',
+                            self.__reconstruct_keys)(version_n)
+
+    def __reconstruct_keys(self, version_n):
+        """
+        Return a new set of the keys in the archived version *version_n*.
+        """
+        if self.__parent is not None and version_n <= self.__fork_n:
+            return self.__parent.__reconstruct_keys(version_n)
+        cache = self.__cache
+        epoch = self.__epoch
+        if cache is not None:
+            cached = cache.get(('keys', version_n))
+            if cached is None:
+                cached = cache.get(('version', version_n))
+            if cached is not None:
+                return set(cached)
+        checkpoint_n = self.__nearest_checkpoint(version_n)
+        if checkpoint_n is None and self.__parent is not None:
+            archived_keys = self.__parent.__reconstruct_keys(self.__fork_n)
+            checkpoint_n = self.__fork_n
+        elif checkpoint_n is None:
+            archived_keys = set(self.__deltas.keys(0)[0])
+            checkpoint_n = self.__stored[0]
+        else:
+            archived_keys = set(self.__checkpoints[checkpoint_n])
+        for pos in self.__positions(checkpoint_n, version_n):
+            added, deleted, _ = self.__deltas.keys(pos)
+            archived_keys.update(added)
+            archived_keys.difference_update(deleted)
+        if cache is not None:
+            keys = frozenset(archived_keys)
+            cache.put(('keys', version_n), keys, sys.getsizeof(keys),
+                      lambda: self.__epoch == epoch)
         return archived_keys
 
+    @_instrumented('lookup_value')
+    @_reader
     def lookup_value(self, key, version_n=None):
         """
         Lookup the value for a given *key* and version number *version_n*.
@@ -270,16 +2091,306 @@ class VersionedDict(dict):
             raise VersionedDictInvalidVersionError(self, version_n)
         if version_n is None or version_n == self.version_number:
             return self[key]
-        for version_i in reversed(range(version_n + 1)):
-            if key in self.__deletions[version_i]:
+        return self.__timed('lookup', self.__lookup)(key, version_n)
+
+    def __lookup(self, key, version_n):
+        """
+        Return the value of *key* in the archive as of *version_n*.
+
+        *version_n* need not be archived itself. Changes up to the oldest
+        archived version are looked up in its delta, which is a complete
+        snapshot. In a fork, changes up to the fork are looked up in the
+        forked instance. If the key is not present, raise a
+        :raise:`KeyError`.
+        """
+        if self.__parent is not None and version_n <= self.__fork_n:
+            return self.__parent.__lookup(key, version_n)
+        versions = self.__history.get(key)
+        if versions:
+            pos = bisect_right(versions, version_n)
+            if pos:
+                if self.__parent is None and \
+                        versions[pos - 1] <= self.__stored[0]:
+                    delta = self.__deltas[0]
+                else:
+                    delta = self.__deltas[self.__position(versions[pos - 1])]
+                if key in delta.addition:
+                    return delta.addition[key]
+                elif key in delta.modification:
+                    value = delta.modification[key]
+                    if type(value) is _Patch:
+                        return self.__resolve_patched(key, versions, pos - 1)
+                    return value
                 raise KeyError(key)
-            elif key in self.__additions[version_i]:
-                return self.__additions[version_i][key]
-            elif key in self.__modifications[version_i]:
-                return self.__modifications[version_i][key]
-        else:
-            raise KeyError(key)
+        if self.__parent is not None:
+            return self.__parent.__lookup(key, self.__fork_n)
+        raise KeyError(key)
+
+    def __resolve_patched(self, key, versions, index):
+        """
+        Return the value of *key* in version *versions[index]*.
 
+        The value in this version is archived as a :class:`_Patch`.
+        Find the latest complete value before (from the archived
+        differences or from a checkpoint) and apply the following patches.
+        """
+        latest = index == len(versions) - 1
+        if latest and key in self.__patched:
+            return self.__patched[key]
+        checkpoint_n = self.__nearest_checkpoint(versions[index])
+        patches = []
+        while True:
+            if checkpoint_n is not None and versions[index] <= checkpoint_n:
+                value = self.__checkpoints[checkpoint_n][key]
+                break
+            if index < 0:
+                value = self.__parent.__lookup(key, self.__fork_n)
+                break
+            if self.__parent is None and versions[index] <= self.__stored[0]:
+                value = self.__deltas[0].addition[key]
+                break
+            delta = self.__deltas[self.__position(versions[index])]
+            value = delta.addition.get(key, MISSING)
+            if value is not MISSING:
+                break
+            value = delta.modification[key]
+            if type(value) is not _Patch:
+                break
+            patches.append(value)
+            index -= 1
+        for patch in reversed(patches):
+            value = patch.apply(value)
+        if latest:
+            self.__patched[key] = value
+        return value
+
+    @_instrumented('lookup_values')
+    @_reader
+    def lookup_values(self, keys, versions, dense=False, missing=MISSING):
+        """
+        Lookup the values of several *keys* in several *versions* at once.
+
+        Return a dict mapping each key to a dict mapping each version
+        number to the value; versions in which the key is not present are
+        left out. If *dense* is True, return a list of rows instead, one per
+        key in the order of *keys*, each a list of the values in the order
+        of *versions*, where an absent key is represented by *missing*.
+
+        If a version is invalid, raise
+        :class:`VersionedDictInvalidVersionError`.
+
+        All lookups are done in one forward sweep over the changes of the
+        keys, starting from the nearest checkpoint.
+
+        Note: Does not return (deep) copies.
+        """
+        keys = list(keys)
+        versions = list(versions)
+        for version_n in versions:
+            if not self.version_number_valid(version_n):
+                raise VersionedDictInvalidVersionError(self, version_n)
+        table = {key: {} for key in keys}
+        if self.version_number in versions:
+            for key in table:
+                if key in self:
+                    table[key][self.version_number] = self[key]
+        archived_versions = sorted(set(versions) - {self.version_number})
+        if self.__parent is not None:
+            shared = bisect_right(archived_versions, self.__fork_n)
+            if shared:
+                rows = self.__parent.lookup_values(
+                    table, archived_versions[:shared])
+                for key, row in rows.items():
+                    table[key].update(row)
+                del archived_versions[:shared]
+        if archived_versions:
+            start_n = self.__nearest_checkpoint(archived_versions[0])
+            if start_n is None and self.__parent is not None:
+                start_n = self.__fork_n
+                snapshot = {}
+                for key in table:
+                    try:
+                        snapshot[key] = self.__parent.__lookup(key, start_n)
+                    except KeyError:
+                        pass
+            elif start_n is None:
+                snapshot = self.__deltas[0].addition
+                start_n = self.__stored[0]
+            else:
+                snapshot = self.__checkpoints[start_n]
+            state = {key: snapshot[key] for key in table if key in snapshot}
+            stop_n = archived_versions[-1]
+            changes = []
+            for key in table:
+                versions_i = self.__history.get(key, ())
+                pos = bisect_right(versions_i, start_n)
+                for version_i in versions_i[pos:]:
+                    if version_i > stop_n:
+                        break
+                    changes.append((version_i, key))
+            changes.sort(key=lambda change: change[0])
+            changes.append((stop_n + 1, None))
+            pos = 0
+            for version_i, key in changes:
+                while pos < len(archived_versions) and \
+                        archived_versions[pos] < version_i:
+                    for key_i, value in state.items():
+                        table[key_i][archived_versions[pos]] = value
+                    pos += 1
+                if key is None:
+                    break
+                delta = self.__deltas[self.__position(version_i)]
+                if key in delta.deletion:
+                    del state[key]
+                elif key in delta.addition:
+                    state[key] = delta.addition[key]
+                else:
+                    value = delta.modification[key]
+                    if type(value) is _Patch:
+                        value = value.apply(state[key])
+                    state[key] = value
+        if dense:
+            return [[table[key].get(version_n, missing)
+                     for version_n in versions] for key in keys]
+        return table
+
+    def iter_versions(self, start=0, stop=None, deltas=False):
+        """
+        Iterate over the versions from *start* to *stop* (exclusive).
+
+        *stop* defaults to the version following the current one.
+        Version *start* is reconstructed once; each following version is
+        derived by applying the next archived difference to it. Versions
+        which have been compacted away are skipped.
+
+        Yield a read-only mapping for each version; it is updated in place
+        in the next step, so copy it (e.g. with :func:`dict`) to keep it.
+        If *deltas* is True, yield tuples (version number, additions,
+        deletions, modifications) instead, where the differences lead from
+        the previous version to this one (for the oldest archived version:
+        from nothing).
+
+        If *start* or *stop* is invalid, raise
+        :class:`VersionedDictInvalidVersionError`.
+
+        Note: Does not yield (deep) copies.
+        """
+        if stop is None:
+            stop = self.version_number + 1
+        if not self.version_number_valid(start):
+            raise VersionedDictInvalidVersionError(self, start)
+        if not isinstance(stop, int):
+            raise VersionedDictInvalidVersionError(self, stop)
+        if stop > self.version_number + 1:
+            raise VersionedDictInvalidVersionError(self, stop - 1)
+        return self.__iter_versions(start, stop, deltas)
+
+    def __iter_versions(self, start, stop, deltas):
+        """
+        Iterate over the versions from the valid *start* to *stop*; see
+        :meth:`iter_versions`.
+        """
+        if start >= stop:
+            return
+        if self.__parent is not None and start <= self.__fork_n:
+            yield from self.__parent.__iter_versions(
+                start, min(stop, self.__fork_n + 1), deltas)
+            start = self.__fork_n + 1
+        positions = self.__positions(start - 1, stop - 1)
+        current = stop > self.version_number
+        if deltas:
+            for pos in positions:
+                yield (self.__stored[pos],) + self.__changes(pos)
+            if current:
+                if self.__latest_archived() is not None:
+                    yield (self.version_number,) + self.diff_previous()
+                else:
+                    yield self.version_number, dict(self), {}, {}
+            return
+        if positions:
+            state = self.__timed('reconstruct', self.__reconstruct)(
+                self.__stored[positions.start])
+            view = MappingProxyType(state)
+            yield view
+        for pos in positions[1:]:
+            delta = self.__deltas[pos]
+            for key in delta.deletion:
+                del state[key]
+            state.update(delta.addition)
+            for key, value in delta.modification.items():
+                if type(value) is _Patch:
+                    value = value.apply(state[key])
+                state[key] = value
+            yield view
+        if current:
+            yield MappingProxyType(self)
+
+    def key_history(self, key):
+        """
+        Iterate over the changes of *key* through all versions.
+
+        Yield pairs (version number, value) for each version in which *key*
+        was added or modified, and (version number, :data:`DELETED`) for
+        each version in which it was deleted. The current version is
+        included, if it differs from the latest archived one. If older
+        versions have been compacted away, the history starts with the
+        value in the oldest archived version.
+
+        Note: Does not yield (deep) copies.
+        """
+        value = MISSING
+        for version_n, value in self.__archived_key_history(key):
+            yield version_n, value
+        if value is DELETED:
+            value = MISSING
+        if self.__latest_archived() is not None and \
+                (self.__full_diff or key in self.__touched):
+            if key not in self:
+                if value is not MISSING:
+                    yield self.version_number, DELETED
+            elif value is MISSING or self.__changed(key, value):
+                yield self.version_number, self[key]
+        elif self.__latest_archived() is None and key in self:
+            yield self.version_number, self[key]
+
+    def __archived_key_history(self, key, stop_n=None):
+        """
+        Iterate over the changes of *key* in the archived versions up to
+        *stop_n* (inclusive; by default all), as :meth:`key_history` does.
+        """
+        value = MISSING
+        versions = self.__history.get(key, ())
+        pos = 0
+        if self.__parent is not None:
+            for version_n, value in self.__parent.__archived_key_history(
+                    key, self.__fork_n):
+                yield version_n, value
+            if value is DELETED:
+                value = MISSING
+        elif self.__stored:
+            base_n = self.__stored[0]
+            pos = bisect_right(versions, base_n)
+            if pos and key in self.__deltas[0].addition:
+                value = self.__deltas[0].addition[key]
+                yield base_n, value
+        if stop_n is not None:
+            versions = versions[:bisect_right(versions, stop_n)]
+        for version_n in versions[pos:]:
+            delta = self.__deltas[self.__position(version_n)]
+            if key in delta.deletion:
+                value = MISSING
+                yield version_n, DELETED
+                continue
+            if key in delta.addition:
+                value = delta.addition[key]
+            elif type(delta.modification[key]) is _Patch:
+                value = delta.modification[key].apply(value)
+            else:
+                value = delta.modification[key]
+            yield version_n, value
+
+    @_instrumented('diff_previous')
+    @_reader
     def diff_previous(self, version_n=None):
         """
         Return information on the difference between two consecutive versions.
@@ -289,40 +2400,630 @@ class VersionedDict(dict):
 
         If *version_n* is None, return the difference of the current version
         against the latest archived one.
+
+        Note: Does not return a (deep) copy.
         """
         if version_n is None:
-            return self.__diff_current_against_latest_archived()
+            return self.__diff_current_against_latest_archived()[:3]
         if version_n < 1:
             return {}, {}, {}
-        return (self.__additions[version_n - 1],
-                self.__deletions[version_n - 1],
-                self.__modifications[version_n - 1])
+        if self.__parent is not None and version_n - 1 <= self.__fork_n:
+            return self.__parent.diff_previous(version_n)
+        pos = self.__position(version_n - 1)
+        if pos is None:
+            raise VersionedDictInvalidVersionError(self, version_n - 1)
+        return self.__changes(pos)
+
+    def __changes(self, pos):
+        """
+        Return the additions, deletions and modifications of the archived
+        difference at index *pos*, with patched values resolved.
+        """
+        addition, deletion, modification = self.__deltas[pos][:3]
+        if any(type(value) is _Patch for value in modification.values()):
+            lookup = self.__timed('lookup', self.__lookup)
+            modification = {key: lookup(key, self.__stored[pos])
+                            for key in modification}
+        return addition, deletion, modification
 
-    def diff_pair(self, version_n1, version_n2):
+    @_instrumented('diff_pair')
+    @_reader
+    def diff_pair(self, version_n1, version_n2, reverse=False):
         """
         Return information on the difference between two arbitrary versions.
 
         Return the additions, deletions and modifications from
         *version_n1* to *version_n2*.
 
+        If *version_n1* is bigger than *version_n2*, return empty
+        differences, unless *reverse* is True; then return the difference
+        backwards from *version_n1* to *version_n2*.
+
+        Only the archived differences between the two versions are
+        examined.
+
         Note: Does not return a (deep) copy.
         """
-        if version_n1 >= version_n2:
+        if version_n1 == version_n2 or (version_n1 > version_n2 and
+                                        not reverse):
             return {}, {}, {}
-        archived_keys1 = self.keys_in_version(version_n=version_n1)
-        archived_keys2 = self.keys_in_version(version_n=version_n2)
+        for version_n in (version_n1, version_n2):
+            if not self.version_number_valid(version_n):
+                raise VersionedDictInvalidVersionError(self, version_n)
+        changes = self.__net_changes(min(version_n1, version_n2),
+                                     max(version_n1, version_n2))
+        backwards = version_n1 > version_n2
+        addition = {}
+        deletion = {}
+        modification = {}
+        differs = self.__timed('compare', self.__differs)
+        for key, (old_value, value) in changes.items():
+            value1, value2 = old_value, value
+            if backwards:
+                value1, value2 = value2, value1
+            if value1 is MISSING:
+                if value2 is not MISSING:
+                    addition[key] = value2
+            elif value2 is MISSING:
+                deletion[key] = value1
+            elif value1 is not value2 and differs(key, value, old_value):
+                modification[key] = value2
+        return addition, deletion, modification
+
+    def __net_changes(self, version_n1, version_n2):
+        """
+        Fold the differences from *version_n1* to *version_n2* into one.
+
+        Return a dict mapping each key changed in between to a pair
+        of its values in both versions; a missing key is represented by
+        :data:`MISSING`. The value of a key may be equal in both versions.
+        """
+        changes = {}
+        if self.__parent is not None and version_n1 < self.__fork_n:
+            changes = self.__parent.__net_changes(
+                version_n1, min(version_n2, self.__fork_n))
+            version_n1 = self.__fork_n
+        positions = self.__positions(version_n1, version_n2)
+        lookup = self.__timed('lookup', self.__lookup)
+        deltas = self.__deltas[positions.start:positions.stop]
+        versions = self.__stored[positions.start:positions.stop]
+        if version_n2 == self.version_number:
+            pending = self.__diff_current_against_latest_archived()
+            deltas.append(_Delta(*pending))
+            versions.append(version_n2)
+        for version_i, delta in zip(versions, deltas):
+            for key, value in delta.addition.items():
+                changes[key] = (changes.get(key, (MISSING,))[0], value)
+            for key, value in delta.deletion.items():
+                changes[key] = (changes.get(key, (value,))[0], MISSING)
+            for key, value in delta.modification.items():
+                if type(value) is _Patch:
+                    value = lookup(key, version_i)
+                if key in changes:
+                    old_value = changes[key][0]
+                elif key in delta.replaced:
+                    old_value = delta.replaced[key]
+                else:
+                    old_value = lookup(key, version_i - 1)
+                changes[key] = (old_value, value)
+        return changes
+
+    @_instrumented('fork')
+    def fork(self):
+        """
+        Return a new instance branching off from the current version.
+
+        The fork has the same options, version number and items (copied
+        according to *copy_strategy*) as this dict. The archived versions
+        are not copied but shared: the fork looks them up in this dict and
+        archives only its own versions. If this dict later rewinds or
+        compacts a shared version, the fork first takes over (references
+        to) the shared history, such that both remain independent.
+        """
+        fork = type(self)(full_diff=self.__full_diff,
+                          checkpoint_interval=self.__checkpoint_interval,
+                          retention=self.__retention)
+        if self.__cache is not None:
+            fork.__cache = type(self.__cache)(self.__cache.max_entries,
+                                              self.__cache.max_bytes)
+        fork.__compression = self.__compression
+        fork.__compression_window = self.__compression_window
+        copy_obj = self.__copy
+        if self.__instruments is not None:
+            copy_obj = copy_obj.func
+        fork.__copy = copy_obj
+        fork.__nested_threshold = self.__nested_threshold
+        fork.__hasher = self.__hasher
+        if self.__fingerprints is not None:
+            fork.__fingerprints = {}
+        if self.__pool is not None:
+            fork.__pool = {}
+        fork.__fork_n = self.__latest_archived()
+        if fork.__fork_n is not None:
+            fork.__parent = self
+        fork.__version = self.__version
+        fork.__touched = set(self.__touched)
+        if self.__instruments is not None:
+            fork.__instrument(_Instruments(self.__instruments.hook))
+        if self.__lock is not None:
+            fork.__lock = threading.RLock()
+        fork.__wrap_methods()
+        dict.update(fork, ((copy_obj(key), copy_obj(value))
+                           for key, value in self.items()))
+        self.__branches = [ref for ref in self.__branches
+                           if ref() is not None]
+        self.__branches.append(weakref.ref(fork))
+        return fork
+
+    def branches(self):
+        """
+        Return a list of the existing forks of this dict, oldest first.
+        """
+        forks = [ref() for ref in self.__branches]
+        return [fork for fork in forks if fork is not None]
+
+    @_instrumented('common_ancestor')
+    def common_ancestor(self, other):
+        """
+        Return the number of the latest archived version shared with the
+        :class:`VersionedDict` *other*.
+
+        A version is shared, if it has been archived before a
+        :meth:`fork` separated both, directly or indirectly, and neither
+        has rewound it since. If there is no shared version, return None.
+        """
+        for version_n in reversed(self.__archived_versions()):
+            token = self._version_token(version_n)
+            if other._version_token(version_n) is token:
+                return version_n
+        return None
+
+    @_instrumented('diff_branch')
+    def diff_branch(self, other):
+        """
+        Return information on the difference to another branch.
+
+        Return the additions, deletions and modifications from the current
+        version of this dict to the current version of *other*, another
+        branch of the same history (see :meth:`fork`). Only the changes of
+        both since their :meth:`common_ancestor` are examined.
+
+        If there is no common ancestor, raise :class:`ValueError`.
+
+        Note: Does not return a (deep) copy.
+        """
+        ancestor_n = self.common_ancestor(other)
+        if ancestor_n is None:
+            raise ValueError('the branches have no common ancestor')
+        changes1 = self.__net_changes(ancestor_n, self.version_number)
+        changes2 = other.__net_changes(ancestor_n, other.version_number)
         addition = {}
-        for key in archived_keys2 - archived_keys1:
-            value = self.lookup_value(key, version_n=version_n2)
-            addition[key] = value
         deletion = {}
-        for key in archived_keys1 - archived_keys2:
-            value = self.lookup_value(key, version_n=version_n1)
-            deletion[key] = value
         modification = {}
-        for key in archived_keys1.intersection(archived_keys2):
-            value1 = self.lookup_value(key, version_n=version_n1)
-            value2 = self.lookup_value(key, version_n=version_n2)
-            if value1 != value2:
+        for key in changes1.keys() | changes2.keys():
+            if key in changes1:
+                value1 = changes1[key][1]
+            else:
+                value1 = changes2[key][0]
+            if key in changes2:
+                value2 = changes2[key][1]
+            else:
+                value2 = changes1[key][0]
+            if value1 is MISSING:
+                if value2 is not MISSING:
+                    addition[key] = value2
+            elif value2 is MISSING:
+                deletion[key] = value1
+            elif value1 is not value2 and value1 != value2:
                 modification[key] = value2
         return addition, deletion, modification
+
+    def __archived_versions(self, stop_n=None):
+        """
+        Return a list of the numbers of the archived versions up to
+        *stop_n* (inclusive; by default all), including shared ones.
+        """
+        if self.__parent is not None:
+            versions = self.__parent.__archived_versions(self.__fork_n)
+        else:
+            versions = []
+        if stop_n is None:
+            versions.extend(self.__stored)
+        else:
+            versions.extend(self.__stored[:bisect_right(self.__stored,
+                                                        stop_n)])
+        return versions
+
+    def __archive_until(self, version_n):
+        """
+        Return the archive up to *version_n* (inclusive), including the
+        shared versions: the lists of the version numbers, deltas and
+        tokens, the history index and the checkpoints, all new objects.
+        """
+        if self.__parent is not None:
+            stored, deltas, tokens, history, checkpoints = \
+                self.__parent.__archive_until(self.__fork_n)
+        else:
+            stored, deltas, tokens, history, checkpoints = [], [], [], {}, {}
+        stop = bisect_right(self.__stored, version_n)
+        stored.extend(self.__stored[:stop])
+        deltas.extend(self.__deltas.records(0, stop))
+        tokens.extend(self.__tokens[:stop])
+        for key, versions in self.__history.items():
+            pos = bisect_right(versions, version_n)
+            if pos:
+                history.setdefault(key, []).extend(versions[:pos])
+        checkpoints.update((checkpoint_n, checkpoint) for checkpoint_n,
+                           checkpoint in self.__checkpoints.items()
+                           if checkpoint_n <= version_n)
+        return stored, deltas, tokens, history, checkpoints
+
+    @_writer
+    def __detach(self):
+        """
+        Take over the history shared with the forked instance, if any.
+
+        Only references to the archived values are copied; the complete
+        snapshot of the oldest version is copied as a dict, because
+        compaction updates it in place.
+        """
+        if self.__parent is None:
+            return
+        stored, deltas, tokens, history, checkpoints = \
+            self.__parent.__archive_until(self.__fork_n)
+        if type(deltas[0]) is _Delta:
+            deltas[0] = _Delta(dict(deltas[0].addition), {}, {}, {})
+        if self.__delta_sizes is not None:
+            self.__delta_sizes[:0] = [_delta_sizeof(delta)
+                                      for delta in deltas]
+        for key, versions in self.__history.items():
+            history.setdefault(key, []).extend(versions)
+        checkpoints.update(self.__checkpoints)
+        self.__stored[:0] = stored
+        self.__deltas[:0] = deltas
+        self.__tokens[:0] = tokens
+        self.__history = history
+        self.__checkpoints = checkpoints
+        self.__parent = None
+        self.__fork_n = None
+        if self.__compression is not None:
+            for pos in range(len(stored)):
+                self.__pack(pos)
+
+    def __detach_branches(self, version_n):
+        """
+        Let the forks sharing *version_n* take over the shared history.
+        """
+        for ref in self.__branches:
+            fork = ref()
+            if fork is not None and fork.__parent is self and \
+                    fork.__fork_n >= version_n:
+                fork.__detach()
+
+    @_instrumented('squash')
+    def squash(self, version_n1, version_n2):
+        """
+        Merge the archived differences after *version_n1* up to
+        *version_n2* into one and return the number of removed versions.
+
+        Both versions must be archived (not the current one); the
+        versions between them are removed from the archive. The folded
+        difference leads from *version_n1* directly to *version_n2*.
+
+        If a version is invalid, raise
+        :class:`VersionedDictInvalidVersionError`; if it is the current
+        version, raise :class:`ValueError`.
+        """
+        for version_n in (version_n1, version_n2):
+            if not self.version_number_valid(version_n):
+                raise VersionedDictInvalidVersionError(self, version_n)
+            if version_n == self.version_number:
+                raise ValueError('version %i is the current version, '
+                                 'not an archived one' % version_n)
+        if version_n1 >= version_n2:
+            raise ValueError('version_n1 must be older than version_n2')
+        self.__detach()
+        positions = self.__positions(version_n1, version_n2)
+        drops = self.__stored[positions.start:positions.stop - 1]
+        self.__compact(drops)
+        return len(drops)
+
+    @_instrumented('prune_before')
+    def prune_before(self, version_n):
+        """
+        Fold all archived versions older than *version_n* into it and
+        return the number of removed versions.
+
+        *version_n* must be archived (not the current one); it becomes
+        the oldest archived version, whose difference is a complete
+        snapshot.
+
+        If the version is invalid, raise
+        :class:`VersionedDictInvalidVersionError`; if it is the current
+        version, raise :class:`ValueError`.
+        """
+        if not self.version_number_valid(version_n):
+            raise VersionedDictInvalidVersionError(self, version_n)
+        if version_n == self.version_number:
+            raise ValueError('version %i is the current version, '
+                             'not an archived one' % version_n)
+        self.__detach()
+        drops = self.__stored[:self.__position(version_n)]
+        self.__compact(drops)
+        return len(drops)
+
+    def __apply_retention(self):
+        """
+        Compact the archive according to the *retention* policy.
+
+        With a log file, the log file is rewritten by a compaction, so
+        *keep_last* is applied only when as many versions can be removed.
+        """
+        policy = self.__retention
+        if policy.keep_last is not None:
+            drops = self.__stored[:-policy.keep_last]
+            if policy.keep_every is not None:
+                drops = [version_n for version_n in drops
+                         if version_n % policy.keep_every]
+            if isinstance(self.__deltas, _DeltaLog) and \
+                    len(drops) < policy.keep_last:
+                drops = []
+            self.__compact(drops)
+        if policy.max_bytes is not None:
+            size = self.__archive_size()
+            while size > policy.max_bytes and len(self.__stored) > 1:
+                pos = 0
+                while size > policy.max_bytes and \
+                        pos < len(self.__stored) - 1:
+                    size -= self.__delta_size(pos)
+                    pos += 1
+                self.__compact(self.__stored[:pos])
+                size = self.__archive_size()
+
+    def __archive_size(self):
+        """
+        Return the estimated size of the archive in bytes.
+        """
+        if isinstance(self.__deltas, _DeltaLog):
+            return self.__deltas.size()
+        if self.__delta_sizes is not None:
+            return sum(self.__delta_sizes)
+        return sum(_delta_sizeof(delta) for delta in self.__deltas)
+
+    def __delta_size(self, pos):
+        """
+        Return the estimated size of the archived difference at *pos*.
+        """
+        if isinstance(self.__deltas, _DeltaLog):
+            return self.__deltas.record_size(pos)
+        return self.__delta_sizes[pos]
+
+    @_writer
+    def __compact(self, drops):
+        """
+        Remove the archived versions *drops* from the archive.
+
+        *drops* is a sorted list of archived versions, not including the
+        latest one. Each run of removed versions is merged into the
+        following archived version; a run at the start becomes part of
+        the snapshot of the oldest remaining version.
+        """
+        if not drops:
+            return
+        self.__detach()
+        self.__detach_branches(drops[0])
+        runs = []
+        for version_n in drops:
+            pos = self.__position(version_n)
+            if runs and runs[-1][1] == pos:
+                runs[-1][1] = pos + 1
+            else:
+                runs.append([pos, pos + 1])
+        replacements = []
+        for start, stop in reversed(runs):
+            if start:
+                delta, keys = self.__merge(start, stop)
+            else:
+                delta, keys = self.__fold_into_base(stop)
+            for key in keys:
+                self.__patched.pop(key, None)
+            for version_n in self.__stored[start:stop]:
+                self.__checkpoints.pop(version_n, None)
+                self.__uncache(version_n)
+            replacements.append((start, stop + 1, delta, self.__stored[stop]))
+        replacements.reverse()
+        self.__deltas.replace(replacements)
+        for start, stop, delta, _ in reversed(replacements):
+            del self.__stored[start:stop - 1]
+            del self.__tokens[start:stop - 1]
+            if self.__delta_sizes is not None:
+                self.__delta_sizes[start:stop] = [_delta_sizeof(delta)]
+        if self.__compression is not None:
+            removed = 0
+            for start, stop, _, _ in replacements:
+                self.__pack(start - removed)
+                removed += stop - start - 1
+
+    def __merge(self, start, stop):
+        """
+        Return the difference folding the archived differences at the
+        indexes *start* to *stop* (inclusive) and the set of affected keys.
+
+        Update the history index and the pool accordingly.
+        """
+        version_n1 = self.__stored[start - 1]
+        version_n2 = self.__stored[stop]
+        changes = self.__net_changes(version_n1, version_n2)
+        differs = self.__timed('compare', self.__differs)
+        delta = _Delta({}, {}, {}, {})
+        for key, (old_value, value) in changes.items():
+            if old_value is MISSING:
+                if value is not MISSING:
+                    delta.addition[key] = value
+            elif value is MISSING:
+                delta.deletion[key] = old_value
+            elif old_value is not value and differs(key, value, old_value):
+                delta.modification[key] = value
+                delta.replaced[key] = old_value
+        if self.__pool is not None:
+            for value in delta.addition.values():
+                self.__retain_value(value)
+            for value in delta.modification.values():
+                self.__retain_value(value)
+            for old_delta in self.__deltas[start:stop + 1]:
+                for value in old_delta.addition.values():
+                    self.__release_value(value)
+                for value in old_delta.modification.values():
+                    self.__release_value(value)
+        merged_keys = self.__delta_keys(delta)
+        for key in changes:
+            versions = self.__history[key]
+            low = bisect_right(versions, version_n1)
+            del versions[low:bisect_right(versions, version_n2)]
+            if key in merged_keys:
+                versions.insert(low, version_n2)
+            elif not versions:
+                del self.__history[key]
+        return delta, changes.keys()
+
+    def __fold_into_base(self, stop):
+        """
+        Return a complete snapshot of the archived version at index *stop*
+        as a difference from nothing, and the set of affected keys.
+
+        The snapshot is derived from the oldest archived version by
+        applying the following differences. Update the history index and
+        the pool accordingly.
+        """
+        base = self.__deltas[0].addition
+        if isinstance(self.__deltas, _DeltaLog) or self.__lock is not None:
+            base = dict(base)
+        keys = set()
+        release_value = self.__release_value
+        for delta in self.__deltas[1:stop + 1]:
+            for key in delta.deletion:
+                release_value(base.pop(key))
+            base.update(delta.addition)
+            for key, value in delta.modification.items():
+                old_value = base[key]
+                if type(value) is _Patch:
+                    value = value.apply(old_value)
+                base[key] = value
+                release_value(old_value)
+            keys.update(self.__delta_keys(delta))
+        version_n = self.__stored[stop]
+        for key in keys:
+            versions = self.__history[key]
+            pos = bisect_right(versions, version_n)
+            if key in base:
+                del versions[:pos - 1]
+            else:
+                del versions[:pos]
+                if not versions:
+                    del self.__history[key]
+        return _Delta(base, {}, {}, {}), keys
+
+    def archive_stats(self):
+        """
+        Return a dict with statistics on the archive.
+
+        It contains the number of archived versions ('versions'), the
+        number of archived versions shared with the forked instance
+        ('shared_versions'; see :meth:`fork`), the number of versions
+        removed by compactions ('compacted'), the
+        estimated size of the archive ('archive_bytes'; see
+        :class:`RetentionPolicy`), the size of the log file ('log_bytes';
+        0 without a log file), the number of checkpoints ('checkpoints'),
+        their total number of entries ('checkpoint_entries') and the
+        estimated size of the checkpoint dicts in bytes
+        ('checkpoint_bytes'; the values are shared with the archive and not
+        counted).
+
+        With *compression* it also contains the number of compressed
+        archived differences ('compressed_versions'), their compressed size
+        ('compressed_bytes') and the size of their uncompressed pickles
+        ('uncompressed_bytes').
+
+        With a cache (see *cache_size*) it also contains the number of
+        cached entries ('cache_entries'), their estimated size
+        ('cache_bytes'), the number of lookups found in the cache
+        ('cache_hits') or not ('cache_misses') and the ratio of hits
+        ('cache_hit_rate').
+
+        With *intern_values* it also contains the number of pooled values
+        ('pool_values'), the number of archived values found in the pool
+        ('pool_hits') or not ('pool_misses'), the ratio of hits
+        ('pool_hit_rate') and the estimated bytes saved by the hits
+        ('pool_bytes_saved').
+
+        With instrumentation (see *instrument*) it also contains dicts
+        mapping the names of the instrumented methods and phases to the
+        number of their calls ('calls') and the total seconds spent in them
+        ('seconds'), and dicts mapping the archived version numbers (not
+        shared with the forked instance) to the number of changed keys
+        ('delta_changes') and the estimated size in bytes ('delta_bytes')
+        of their archived differences.
+        """
+        shared = 0
+        if self.__parent is not None:
+            shared = len(self.__parent.__archived_versions(self.__fork_n))
+        stats = {
+            'versions': len(self.__deltas),
+            'shared_versions': shared,
+            'compacted': self.__version - len(self.__deltas) - shared,
+            'archive_bytes': self.__archive_size(),
+            'log_bytes': (self.__deltas.size()
+                          if isinstance(self.__deltas, _DeltaLog) else 0),
+            'checkpoints': len(self.__checkpoints),
+            'checkpoint_entries': sum(len(checkpoint) for checkpoint
+                                      in self.__checkpoints.values()),
+            'checkpoint_bytes': sum(sys.getsizeof(checkpoint) for checkpoint
+                                    in self.__checkpoints.values()),
+        }
+        if self.__compression is not None:
+            packed, packed_bytes, unpacked_bytes = \
+                self.__deltas.packed_sizes()
+            stats.update({
+                'compressed_versions': packed,
+                'compressed_bytes': packed_bytes,
+                'uncompressed_bytes': unpacked_bytes,
+            })
+        if self.__cache is not None:
+            lookups = self.__cache.hits + self.__cache.misses
+            stats.update({
+                'cache_entries': len(self.__cache),
+                'cache_bytes': self.__cache.bytes,
+                'cache_hits': self.__cache.hits,
+                'cache_misses': self.__cache.misses,
+                'cache_hit_rate': (self.__cache.hits / lookups
+                                   if lookups else 0.0),
+            })
+        if self.__pool is not None:
+            hits = self.__pool_stats['hits']
+            lookups = hits + self.__pool_stats['misses']
+            stats.update({
+                'pool_values': len(self.__pool),
+                'pool_hits': hits,
+                'pool_misses': self.__pool_stats['misses'],
+                'pool_hit_rate': hits / lookups if lookups else 0.0,
+                'pool_bytes_saved': self.__pool_stats['bytes_saved'],
+            })
+        if self.__instruments is not None:
+            stats.update({
+                'calls': dict(self.__instruments.calls),
+                'seconds': dict(self.__instruments.seconds),
+                'delta_changes': {
+                    version_n: sum(map(len, self.__deltas.keys(pos)))
+                    for pos, version_n in enumerate(self.__stored)},
+                'delta_bytes': {
+                    version_n: self.__delta_size(pos)
+                    for pos, version_n in enumerate(self.__stored)},
+            })
+        return stats
+
+
+_MARKED_METHODS = tuple(
+    (name, getattr(method, 'instrument_name', None),
+     getattr(method, 'concurrency', None))
+    for name, method in vars(VersionedDict).items()
+    if hasattr(method, 'instrument_name') or hasattr(method, 'concurrency'))